@@ -26,7 +26,8 @@ import tank.platform.constants as constants
 
 from .utility import (platform_tank_map,
                       link_bootstrapper)
-from .utility.patch import PatchSet
+from .utility.patch import (PatchSet,
+                            fromcompiled)
 from butility.compat import StringIO
 
 
@@ -56,6 +57,10 @@ class SetupTankProject(object):
     ## it will be a 'shallow' copy, using the studio installation
     tank_subtree = 'tank'
 
+    ## Amount of context lines which may be ignored when placing the root_programs_patch hunks
+    ## The tank wrappers tend to shift by a few lines between tk-core releases
+    root_programs_fuzz = 2
+
     ## -- End Configuration -- @}
 
 
@@ -219,6 +224,18 @@ class SetupTankProject(object):
 
         return settings
 
+    @classmethod
+    def _root_programs_patchset(cls, **params):
+        """@return a PatchSet of our root_programs_patch, with template parameters substituted by the given
+        keyword arguments.
+        @note the patch is only parsed once per class, later calls just load its compiled form"""
+        compiled = cls.__dict__.get('_root_programs_patch_compiled')
+        if compiled is None:
+            compiled = PatchSet(stream=StringIO(cls.root_programs_patch)).compile()
+            cls._root_programs_patch_compiled = compiled
+        # end compile on first use
+        return fromcompiled(compiled, **params)
+
     ## -- End Utilities -- @}
 
 
@@ -303,8 +320,8 @@ class SetupTankProject(object):
         # end for each os name
 
         # Finally, setup the tank configuration to use our bootstrapper
-        patch = self.root_programs_patch.format(windows_python2_interpreter_path=win_py2_interpreter)
-        if not PatchSet(stream=StringIO(patch)).apply(root=tank_os_root):
+        patch = self._root_programs_patchset(windows_python2_interpreter_path=win_py2_interpreter)
+        if not patch.apply(root=tank_os_root, fuzz=self.root_programs_fuzz, atomic=True):
             raise AssertionError("Couldn't apply patch to root programs - they must have changed too much")
         # end handle patch
 
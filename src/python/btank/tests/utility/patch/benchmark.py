@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+python-patch benchmark suite
+
+Measures throughput of parsing, diffstat, applying and reverting
+on synthetic workloads, which are generated into a temporary directory:
+
+ - manyfiles  - 10k files with a single hunk each
+ - bigfile    - a single file with a million lines and a few hunks
+ - manyhunks  - a single file with 20k small hunks
+ - mixedcrlf  - files with alternating CRLF and LF line ends
+
+Every workload runs in a fresh process, so its peak memory can be
+reported. Results are compared against timings recorded in
+baselines.json, and slower phases are reported as regressions:
+
+  python benchmark.py [--scale N] [workload ...]
+  python benchmark.py --record
+
+Baselines depend on the machine - record them on the machine that
+runs the benchmark.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+from multiprocessing import Pool
+from optparse import OptionParser
+from os.path import abspath, dirname, exists, join
+from tempfile import mkdtemp
+
+try:
+    import resource
+except ImportError:
+    # not available on windows - memory isn't reported there
+    resource = None
+
+import btank.utility.patch as patch
+
+
+# file with timings recorded by --record
+baselines_file = join(dirname(abspath(__file__)), 'baselines.json')
+
+# phases measured for every workload, in order
+phases = ('parse', 'diffstat', 'apply', 'revert')
+
+
+# ----------------------------------------------------------------------------
+# Generators write source files of a workload into `root` and its
+# unified diff into file object `out`
+
+def write_pair(root, name, count, changes, ends, out):
+    """ write file `name` with `count` lines into `root` and the diff changing
+        every line listed in `changes` into `out`. Changed lines must be at least
+        7 lines apart, so hunks with 3 lines of context don't overlap.
+        Line ends are taken from `ends` sequence in turn.
+    """
+    def line(i):
+        return "%s line %d%s" % (name, i, ends[i % len(ends)])
+
+    path = join(root, name)
+    if not exists(dirname(path)):
+        os.makedirs(dirname(path))
+    fp = open(path, 'wb')
+    try:
+        for block in xrange(0, count, 10000):
+            fp.write(''.join(line(i) for i in xrange(block, min(block + 10000, count))))
+    finally:
+        fp.close()
+
+    out.write("--- %s\n+++ %s\n" % (name, name))
+    for pos in changes:
+        start = max(pos - 3, 0)
+        end = min(pos + 4, count)
+        hunk = ["@@ -%d,%d +%d,%d @@\n" % (start+1, end-start, start+1, end-start)]
+        hunk.extend(' ' + line(i) for i in xrange(start, pos))
+        hunk.append('-' + line(pos))
+        hunk.append('+' + line(pos).replace(' line ', ' changed line ', 1))
+        hunk.extend(' ' + line(i) for i in xrange(pos + 1, end))
+        out.write(''.join(hunk))
+
+def scaled(count, scale):
+    return max(int(count * scale), 1)
+
+def manyfiles(root, scale, out):
+    for k in xrange(scaled(10000, scale)):
+        write_pair(root, "dir%02d/file%05d.txt" % (k % 100, k), 40, [20], ("\n",), out)
+
+def bigfile(root, scale, out):
+    count = scaled(1000000, scale)
+    write_pair(root, "big.txt", count, range(5, count, max(count // 100, 10)), ("\n",), out)
+
+def manyhunks(root, scale, out):
+    count = scaled(200000, scale)
+    write_pair(root, "hunks.txt", count, range(5, count, 10), ("\n",), out)
+
+def mixedcrlf(root, scale, out):
+    for k in xrange(scaled(100, scale)):
+        write_pair(root, "mixed%03d.txt" % k, 2000, range(5, 2000, 50), ("\r\n", "\n"), out)
+
+workloads = dict(manyfiles=manyfiles, bigfile=bigfile, manyhunks=manyhunks,
+                 mixedcrlf=mixedcrlf)
+
+
+# ----------------------------------------------------------------------------
+
+def treesize(root):
+    """ return total size of files in `root` directory """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        size += sum(os.path.getsize(join(dirpath, f)) for f in filenames)
+    return size
+
+def measure(name, scale=1.0):
+    """ generate workload `name` and return dict mapping every phase to dict
+        with `seconds` and throughput in `mbps`, along with peak `memory` of
+        the process in MB (None if unknown)
+    """
+    tmpdir = mkdtemp(prefix="patchbench.")
+    try:
+        root = join(tmpdir, 'root')
+        patchfile = join(tmpdir, name + '.diff')
+        out = open(patchfile, 'wb')
+        try:
+            workloads[name](root, scale, out)
+        finally:
+            out.close()
+        sizes = dict(parse=os.path.getsize(patchfile), diffstat=os.path.getsize(patchfile))
+        sizes['apply'] = sizes['revert'] = treesize(root)
+
+        seconds = {}
+        started = time.time()
+        pto = patch.fromfile(patchfile)
+        seconds['parse'] = time.time() - started
+        if pto.errors:
+            raise AssertionError("%s: patch has %d errors" % (name, pto.errors))
+
+        started = time.time()
+        pto.diffstat()
+        seconds['diffstat'] = time.time() - started
+
+        for phase, method in (('apply', pto.apply), ('revert', pto.revert)):
+            started = time.time()
+            if not method(root=root):
+                raise AssertionError("%s: %s failed" % (name, phase))
+            seconds[phase] = time.time() - started
+    finally:
+        shutil.rmtree(tmpdir)
+
+    result = {}
+    for phase in phases:
+        result[phase] = dict(seconds=round(seconds[phase], 4),
+                             mbps=round(sizes[phase] / 1e6 / max(seconds[phase], 1e-6), 1))
+    result['memory'] = None
+    if resource:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on mac, kilobytes elsewhere
+        result['memory'] = round(maxrss / (sys.platform == 'darwin' and 1e6 or 1e3), 1)
+    return result
+
+def run(names, scale=1.0):
+    """ return dict mapping workload names to results of `measure()`, every
+        workload is measured in a fresh process
+    """
+    results = {}
+    for name in names:
+        pool = Pool(1)
+        try:
+            results[name] = pool.apply(measure, (name, scale))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+def compare(results, baselines, tolerance=1.5, slack=0.05):
+    """ return list of regressions - (workload, phase, value, baseline) tuples
+        for phases that took more than `tolerance` times longer than baseline,
+        or workloads that needed more than `tolerance` times more memory.
+        Phases are only reported if they got at least `slack` seconds slower,
+        so timer noise of very fast phases isn't a regression.
+    """
+    regressions = []
+    for name in sorted(results):
+        known = baselines.get(name)
+        if not known:
+            continue
+        result = results[name]
+        for phase in phases:
+            seconds, baseline = result[phase]['seconds'], known[phase]['seconds']
+            if seconds > baseline * tolerance and seconds - baseline >= slack:
+                regressions.append((name, phase, seconds, baseline))
+        if result['memory'] and known['memory'] and \
+           result['memory'] > known['memory'] * tolerance:
+            regressions.append((name, 'memory', result['memory'], known['memory']))
+    return regressions
+
+def load_baselines(scale):
+    """ return baselines recorded for `scale`, or empty dict """
+    if not exists(baselines_file):
+        return {}
+    fp = open(baselines_file, 'rb')
+    try:
+        data = json.load(fp)
+    finally:
+        fp.close()
+    if data.get('scale') != scale:
+        return {}
+    return data['workloads']
+
+def save_baselines(results, scale):
+    fp = open(baselines_file, 'wb')
+    try:
+        json.dump(dict(scale=scale, workloads=results), fp, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        fp.write("\n")
+    finally:
+        fp.close()
+
+
+if __name__ == "__main__":
+    opt = OptionParser(usage="%prog [options] [workload ...]\n\n"
+                             "workloads: " + ", ".join(sorted(workloads)))
+    opt.add_option("-s", "--scale", type="float", default=1.0,
+                   help="multiply size of workloads by SCALE")
+    opt.add_option("-t", "--tolerance", type="float", default=1.5,
+                   help="report phases slower than TOLERANCE times baseline")
+    opt.add_option("--record", action="store_true",
+                   help="store results as new baselines")
+    (options, args) = opt.parse_args()
+
+    names = args or sorted(workloads)
+    for name in names:
+        if name not in workloads:
+            opt.error("unknown workload - %s" % name)
+
+    results = run(names, options.scale)
+    for name in names:
+        result = results[name]
+        print "%-10s" % name,
+        for phase in phases:
+            print " %s %7.3fs %7.1f MB/s" % (phase, result[phase]['seconds'],
+                                              result[phase]['mbps']),
+        if result['memory']:
+            print " peak %.0f MB" % result['memory'],
+        print
+
+    if options.record:
+        baselines = load_baselines(options.scale)
+        baselines.update(results)
+        save_baselines(baselines, options.scale)
+        sys.exit(0)
+
+    regressions = compare(results, load_baselines(options.scale), options.tolerance)
+    for name, phase, value, baseline in regressions:
+        print "regression: %s %s %.3f (baseline %.3f)" % (name, phase, value, baseline)
+    regressions and sys.exit(1)
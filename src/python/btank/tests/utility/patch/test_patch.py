@@ -30,14 +30,19 @@ On Windows it may be more convenient instead of `coverage` call
 `python -m coverage.__main__`
 """
 
+import logging
+import marshal
 import os
 import sys
 import re
 import shutil
+import threading
+import time
 import unittest
 import copy
 from os import listdir
 from os.path import abspath, dirname, exists, join, isdir, isfile
+from StringIO import StringIO
 from tempfile import mkdtemp
 
 verbose = False
@@ -53,6 +58,9 @@ def fixture(name):
 
 # import patch.py from parent directory
 import btank.utility.patch as patch
+# benchmark.py lives next to this file, which is not in a package
+sys.path.insert(0, tests_dir)
+import benchmark
 
 
 # ----------------------------------------------------------------------------
@@ -204,6 +212,50 @@ class TestCheckPatched(unittest.TestCase):
         pto2 = patch.fromfile("04can_patch.patch")
         self.assertFalse(pto2.can_patch("04can_patch.to"))
 
+    def test_can_patch_with_root(self):
+        pto = patch.fromfile("01uni_multi/01uni_multi.patch")
+        os.chdir(self.save_cwd)
+        self.assert_(pto.can_patch("updatedlg.cpp",
+                                   root=join(tests_dir, "01uni_multi", "[result]")))
+        self.assertFalse(pto.can_patch("updatedlg.cpp", root=join(tests_dir, "01uni_multi")))
+
+    def test_check_reports_status_per_hunk(self):
+        pto = patch.fromfile("01uni_multi/01uni_multi.patch")
+        hunks = pto.items[0].hunks
+        lines = pto.linetable("01uni_multi/updatedlg.cpp")
+        self.assertEqual(pto.check(lines, hunks), [patch.APPLIES] * len(hunks))
+        lines = pto.linetable("01uni_multi/[result]/updatedlg.cpp")
+        self.assertEqual(pto.check(lines, hunks), [patch.APPLIED] * len(hunks))
+        lines[hunks[0].starttgt] = "conflicting line"
+        self.assertEqual(pto.check(lines, hunks)[0], patch.CONFLICT)
+
+    def test_can_patch_all(self):
+        pto = patch.fromfile("01uni_multi/01uni_multi.patch")
+        root = join(tests_dir, "01uni_multi")
+        self.assertEqual(pto.can_patch_all(root=root),
+                         dict((p.source, patch.APPLIES) for p in pto))
+        result = pto.can_patch_all(["updatedlg.cpp", "conf.h", "missing"],
+                                   root=join(root, "[result]"))
+        self.assertEqual(result, {"updatedlg.cpp": patch.APPLIED,
+                                  "conf.h": patch.APPLIED, "missing": None})
+        self.assert_(pto.sourceindex(root) is pto.sourceindex(root))
+
+    def test_sourceindex_follows_current_dir(self):
+        pto = patch.fromfile("01uni_multi/01uni_multi.patch")
+        os.chdir(join(tests_dir, "01uni_multi"))
+        self.assert_(abspath("updatedlg.cpp") in pto.sourceindex())
+        self.assertEqual(pto.can_patch_all(["updatedlg.cpp"]),
+                         {"updatedlg.cpp": patch.APPLIES})
+        os.chdir("[result]")
+        self.assert_(abspath("updatedlg.cpp") in pto.sourceindex())
+        self.assertEqual(pto.can_patch_all(["updatedlg.cpp"]),
+                         {"updatedlg.cpp": patch.APPLIED})
+        # relative root follows current dir as well
+        self.assert_(join(tests_dir, "01uni_multi", "[result]", "updatedlg.cpp")
+                     in pto.sourceindex("."))
+        os.chdir(tests_dir)
+        self.assert_(join(tests_dir, "updatedlg.cpp") in pto.sourceindex("."))
+
 # ----------------------------------------------------------------------------
 
 class TestPatchParse(unittest.TestCase):
@@ -223,6 +275,47 @@ class TestPatchParse(unittest.TestCase):
         ps2 = patch.fromfile(fixture("failing/not-a-patch.log"))
         self.assertFalse(ps2)
 
+    def test_iterparse(self):
+        fp = open(join(tests_dir, "01uni_multi/01uni_multi.patch"), "rb")
+        pst = patch.PatchSet()
+        names = [p.target for p in pst.iterparse(fp)]
+        fp.close()
+        self.assertEqual(names, ['updatedlg.cpp', 'updatedlg.h', 'manifest.xml',
+                                 'conf.cpp', 'conf.h'])
+        self.assertEqual(len(pst), 0)
+        self.assertEqual(pst.errors, 0)
+        self.assertEqual(pst.type, patch.SVN)
+
+    def test_parse_jobs(self):
+        for name in ("01uni_multi/01uni_multi.patch", "data/git-changed-file.diff",
+                     "data/failing/missing-hunk-line.diff"):
+            serial = patch.PatchSet(open(join(tests_dir, name), "rb"))
+            parallel = patch.PatchSet()
+            parallel.parse(open(join(tests_dir, name), "rb"), jobs=2)
+            self.assertEqual((parallel.errors, parallel.warnings, parallel.type),
+                             (serial.errors, serial.warnings, serial.type))
+            self.assertEqual([(p.source, p.target, p.header, [h.text for h in p])
+                              for p in parallel],
+                             [(p.source, p.target, p.header, [h.text for h in p])
+                              for p in serial])
+
+    def test_compiled(self):
+        pto = patch.fromfile(join(tests_dir, "01uni_multi/01uni_multi.patch"))
+        loaded = patch.fromcompiled(pto.compile())
+        self.assertEqual((loaded.type, loaded.errors, loaded.diffstat()),
+                         (pto.type, pto.errors, pto.diffstat()))
+        self.assertEqual([[h.text for h in p] for p in loaded],
+                         [[h.text for h in p] for p in pto])
+
+        data = patch.PatchSet(StringIO("--- {name}\n+++ {name}\n@@ -1 +1 @@\n"
+                                       "-a\n+{value} {other}\n")).compile()
+        loaded = patch.fromcompiled(data, name='conf.h', value='long value')
+        self.assertEqual(loaded.items[0].target, 'conf.h')
+        self.assertEqual(loaded.items[0].hunks[0].text[1], '+long value {other}\n')
+        self.assertEqual(loaded.items[0].delta, 17)
+        self.assertRaises(ValueError, patch.fromcompiled,
+                          marshal.dumps((0,) + marshal.loads(data)[1:]))
+
     def test_no_header_for_plain_diff_with_single_file(self):
         pto = patch.fromfile(join(tests_dir, "03trail_fname.patch"))
         self.assertEqual(pto.items[0].header, [])
@@ -236,6 +329,15 @@ class TestPatchParse(unittest.TestCase):
         pto = patch.fromfile(fixture('git-changed-file.diff'))
         self.assertEqual(pto.items[0].hunks[0].desc, 'class JSONPluginMgr(object):')
 
+    def test_hunk_lines(self):
+        pto = patch.fromfile(join(tests_dir, "03trail_fname.patch"))
+        h = pto.items[0].hunks[0]
+        self.assertEqual(len(h.srclines), h.linessrc)
+        self.assertEqual(len(h.tgtlines), h.linestgt)
+        self.assertEqual(list(h.srclines)[2], "- trailing spaces in patch filenames")
+        self.assertEqual(list(h.tgtlines)[3:5], ["", "Features:"])
+        self.assertEqual(h.text[2], "-- trailing spaces in patch filenames\r\n")
+
     def test_autofixed_absolute_path(self):
         pto = patch.fromfile(join(tests_dir, "data/autofix/absolute-path.diff"))
         self.assertEqual(pto.errors, 0)
@@ -262,6 +364,17 @@ class TestPatchParse(unittest.TestCase):
         self.assertNotEqual(pto.parse(fp), True)
         fp.close()
 
+    def test_fail_invalid_and_extra_hunk_lines(self):
+        pto = patch.PatchSet(StringIO("--- a\n+++ a\n@@ -1,2 +1,2 @@\n one\n\n"
+                                      "@@ -5 +5 @@\n-two\n-three\n"
+                                      "--- b\n+++ b\n@@ -1 +1 @@\n-x\n*y\n"))
+        self.assertEqual(pto.errors, 2)
+        self.assertEqual(pto.warnings, 1)  # expanded empty line
+        self.assertEqual([len(p.hunks) for p in pto], [2, 1])
+        self.assertFalse(pto.items[0].hunks[0].invalid)
+        self.assert_(pto.items[0].hunks[1].invalid)
+        self.assert_(pto.items[1].hunks[0].invalid)
+
     def test_fail_context_format(self):
         fp = open(join(tests_dir, "data/failing/context-format.diff"))
         res = patch.PatchSet().parse(fp)
@@ -285,6 +398,17 @@ class TestPatchParse(unittest.TestCase):
         pto = patch.fromfile(join(tests_dir, "01uni_multi/01uni_multi.patch"))
         self.assertEqual(pto.diffstat(), output, "Output doesn't match")
 
+    def test_diffstat_dict(self):
+        pto = patch.fromfile(join(tests_dir, "01uni_multi/01uni_multi.patch"))
+        stat = pto.diffstat_dict()
+        self.assertEqual((stat['insertions'], stat['deletions'], stat['delta']),
+                         (48, 18, 1203))
+        self.assertEqual(stat['files'][1], dict(name='updatedlg.h', insertions=1,
+                                                deletions=0, delta=54))
+        stat = pto.reversed().diffstat_dict()
+        self.assertEqual((stat['insertions'], stat['deletions'], stat['delta']),
+                         (18, 48, -1203))
+
 class TestPatchSetDetect(unittest.TestCase):
     def test_svn_detected(self):
         pto = patch.fromfile(join(tests_dir, "01uni_multi/01uni_multi.patch"))
@@ -340,12 +464,526 @@ class TestPatchApply(unittest.TestCase):
         self.assertEqual(open(self.tmpdir + '/03trail_fname.from').read(),
                          open(tests_dir + '/03trail_fname.from').read())
 
+    def test_reversed_view(self):
+        pto = patch.fromfile(join(tests_dir, '03trail_fname.patch'))
+        h = pto.items[0].hunks[0]
+        text = h.text
+        rh = pto.reversed().items[0].hunks[0]
+        self.assertEqual((rh.startsrc, rh.linessrc), (h.starttgt, h.linestgt))
+        self.assertEqual(list(rh.srclines), list(h.tgtlines))
+        self.assertEqual([l[0] for l in rh.text],
+                         [{'+': '-', '-': '+'}.get(l[0], l[0]) for l in text])
+        self.assertEqual(h.text, text)
+        self.assert_(rh.reversed() is h)
+        self.assert_(rh.lines is h.lines)
+
+    def test_reversed_view_copy(self):
+        patchfile = join(tests_dir, '03trail_fname.patch')
+        pto = patch.fromfile(patchfile, mapped=True)
+        view = pto.reversed()
+        for copied in (copy.copy(view), copy.deepcopy(view)):
+            self.assertEqual([h.text for p in copied for h in p],
+                             [h.text for p in view for h in p])
+            self.assertEqual([(p.source, p.target) for p in copied],
+                             [(p.source, p.target) for p in view])
+        rp = view.items[0]
+        self.assertEqual(copy.copy(rp.hunks[0]).text, rp.hunks[0].text)
+        self.assertEqual(copy.deepcopy(rp).insertions, rp.insertions)
+        # closing the view leaves maps of the original alone
+        view.close()
+        self.assertEqual(pto.items[0].hunks[0].text,
+                         patch.fromfile(patchfile).items[0].hunks[0].text)
+        pto.close()
+
+    def test_apply_fuzz(self):
+        self.tmpcopy(['03trail_fname.patch'])
+        source = open(join(tests_dir, '03trail_fname.from'), 'rb').read()
+        target = open(join(tests_dir, '03trail_fname.to'), 'rb').read()
+        # shifted by two lines, first context line changed
+        shifted = "Notes\n\n" + source.replace("Tests:", "Test cases:", 1)
+        open('03trail_fname.from', 'wb').write(shifted)
+        pto = patch.fromfile('03trail_fname.patch')
+        self.assertFalse(pto.apply())
+        self.assertFalse(pto.apply(fuzz=0))
+        self.assert_(pto.apply(fuzz=1))
+        self.assertEqual(open('03trail_fname.from', 'rb').read(),
+                         "Notes\n\n" + target.replace("Tests:", "Test cases:", 1))
+        # already patched file is detected at an offset as well
+        self.assert_(pto.apply(fuzz=1))
+
+    def test_apply_fuzz_hunk_order(self):
+        pto = patch.fromstring("--- f\n+++ f\n"
+                               "@@ -1,3 +1,3 @@\n p\n-q\n+Q\n r\n"
+                               "@@ -5,3 +5,3 @@\n 5\n-6\n+SIX\n 7\n")
+        # second hunk matches at its line, but before the relocated first one
+        source = "1\n2\n3\n4\n5\n6\n7\n8\np\nq\nr\n"
+        open('f', 'wb').write(source)
+        self.assertFalse(pto.apply(fuzz=0))
+        self.assertEqual(open('f', 'rb').read(), source)
+        self.assertFalse(pto.apply_buffers({'f': source}, fuzz=2))
+        # it is looked up after the first one
+        open('f', 'wb').write(source + "5\n6\n7\n")
+        self.assert_(pto.apply(fuzz=2))
+        self.assertEqual(open('f', 'rb').read(),
+                         "1\n2\n3\n4\n5\n6\n7\n8\np\nQ\nr\n5\nSIX\n7\n")
+
+    def test_apply_stats(self):
+        self.tmpcopy(['03trail_fname.patch'])
+        source = open(join(tests_dir, '03trail_fname.from'), 'rb').read()
+        open('03trail_fname.from', 'wb').write("Notes\n\n" + source)
+        data = open('03trail_fname.patch', 'rb').read()
+        pto = patch.fromfile('03trail_fname.patch')
+        stats = pto.stats
+        self.assertEqual((stats.lines, stats.bytes), (len(data.splitlines()), len(data)))
+        self.assert_(pto.apply(fuzz=1))
+        entry = stats.files['03trail_fname.from']
+        self.assertEqual(entry['fuzz'], [(1, 2, 0)])
+        self.assertEqual(stats.slowest(), [(entry['validate'] + entry['write'],
+                                            '03trail_fname.from')])
+
     def test_apply_root(self):
         treeroot = join(self.tmpdir, 'rootparent')
         shutil.copytree(join(tests_dir, '06nested'), treeroot)
         pto = patch.fromfile(join(tests_dir, '06nested/06nested.patch'))
         self.assert_(pto.apply(root=treeroot))
 
+    def test_apply_root_keeps_working_dir(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '06nested'), treeroot)
+        pto = patch.fromfile(join(tests_dir, '06nested/06nested.patch'))
+        chdir = os.chdir
+        def nochdir(path):
+          self.fail("working dir changed to %s" % path)
+        os.chdir = nochdir
+        try:
+          self.assert_(pto.apply(root=treeroot))
+          self.assert_(pto.revert(root=treeroot, jobs=2))
+        finally:
+          os.chdir = chdir
+        self.assertEqual(os.getcwdu(), self.tmpdir)
+
+    def test_apply_mapped(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '06nested'), treeroot)
+        patchfile = join(tests_dir, '06nested/06nested.patch')
+        pto = patch.fromfile(patchfile, mapped=True)
+        self.assertEqual([h.text for p in pto for h in p],
+                         [h.text for p in patch.fromfile(patchfile) for h in p])
+        self.assert_(isinstance(pto.items[0].hunks[0], patch.MappedHunk))
+        self.assert_(pto.apply(root=treeroot))
+        self.assertEqual(open(join(treeroot, 'examples/font_comparison.py'), 'rb').read(),
+                         open(join(tests_dir, '06nested/[result]/examples/font_comparison.py'), 'rb').read())
+        self.assert_(pto.revert(root=treeroot))
+
+    def test_close_mapped(self):
+        patchfile = join(self.tmpdir, '06nested.patch')
+        shutil.copy(join(tests_dir, '06nested/06nested.patch'), patchfile)
+        pto = patch.fromfile(patchfile, mapped=True)
+        hunk = pto.items[0].hunks[0]
+        self.assert_(hunk.text)
+        pto.close()
+        self.assertRaises(ValueError, lambda: hunk.text)
+        pto.close()  # closing twice is harmless
+        # file is free to be replaced and removed
+        shutil.copy(join(tests_dir, '01uni_multi/01uni_multi.patch'), patchfile)
+        pto = patch.fromfile(patchfile, mapped=True)
+        self.assertEqual(len(pto), 5)
+        pto.close()
+        os.unlink(patchfile)
+        self.assertFalse(exists(patchfile))
+
+    def test_apply_many(self):
+        roots = [join(self.tmpdir, 'root%d' % i) for i in range(3)]
+        for root in roots:
+            shutil.copytree(join(tests_dir, '06nested'), root)
+        open(join(roots[1], 'examples/font_comparison.py'), 'wb').write('conflict\n')
+        pto = patch.fromfile(join(tests_dir, '06nested/06nested.patch'))
+        reports = pto.apply_many(roots, jobs=2, atomic=True)
+        self.assertEqual([reports[root]['success'] for root in roots], [True, False, True])
+        self.assert_('examples/font_comparison.py' in reports[roots[0]]['stats'].files)
+        for root in roots[::2]:
+            self.assertEqual(open(join(root, 'experimental/console.py'), 'rb').read(),
+                             open(join(tests_dir, '06nested/[result]/experimental/console.py'),
+                                  'rb').read())
+        self.assertEqual(open(join(roots[1], 'experimental/console.py'), 'rb').read(),
+                         open(join(tests_dir, '06nested/experimental/console.py'), 'rb').read())
+
+        reports = pto.reversed().apply_many(roots[::2])
+        self.assert_(all(report['success'] for report in reports.values()))
+        self.assertEqual(open(join(roots[2], 'experimental/console.py'), 'rb').read(),
+                         open(join(tests_dir, '06nested/experimental/console.py'), 'rb').read())
+
+    def test_apply_stream(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '06nested'), treeroot)
+        fp = open(join(tests_dir, '06nested/06nested.patch'), 'rb')
+        pto = patch.PatchSet()
+        self.assert_(pto.apply_stream(fp, root=treeroot))
+        fp.close()
+        self.assertEqual(len(pto), 0)
+        self.assertEqual(open(join(treeroot, 'experimental/console.py'), 'rb').read(),
+                         open(join(tests_dir, '06nested/[result]/experimental/console.py'), 'rb').read())
+
+    def test_apply_jobs(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '01uni_multi'), treeroot)
+        pto = patch.fromfile(join(tests_dir, '01uni_multi/01uni_multi.patch'))
+        self.assert_(pto.apply(root=treeroot, jobs=3))
+        for p in pto:
+          self.assertEqual(open(join(treeroot, p.target), 'rb').read(),
+                           open(join(tests_dir, '01uni_multi/[result]', p.target), 'rb').read())
+
+        # messages of workers are emitted in order of files
+        messages = []
+        class Recorder(logging.Handler):
+          def emit(self, record):
+            messages.append(record.getMessage())
+        handler = Recorder()
+        patch.logger.addHandler(handler)
+        try:
+          self.assert_(pto.apply(root=treeroot))
+          serial = messages[:]
+          del messages[:]
+          self.assert_(pto.apply(root=treeroot, jobs=5))
+        finally:
+          patch.logger.removeHandler(handler)
+        self.assertEqual(len(serial), len(pto))
+        self.assertEqual(messages, serial)
+
+    def test_apply_atomic(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '01uni_multi'), treeroot)
+        pto = patch.fromfile(join(tests_dir, '01uni_multi/01uni_multi.patch'))
+        conf = open(join(treeroot, 'conf.h'), 'rb').read()
+        open(join(treeroot, 'conf.h'), 'wb').write('conflict\n' + conf)
+        before = sorted(os.listdir(treeroot))
+        self.assertFalse(pto.apply(root=treeroot, atomic=True))
+        # nothing was touched or left behind
+        self.assertEqual(sorted(os.listdir(treeroot)), before)
+        self.assertEqual(open(join(treeroot, 'updatedlg.cpp'), 'rb').read(),
+                         open(join(tests_dir, '01uni_multi/updatedlg.cpp'), 'rb').read())
+
+        open(join(treeroot, 'conf.h'), 'wb').write(conf)
+        self.assert_(pto.apply(root=treeroot, atomic=True, jobs=2))
+        self.assertEqual(sorted(os.listdir(treeroot)), before)
+        for p in pto:
+          self.assertEqual(open(join(treeroot, p.target), 'rb').read(),
+                           open(join(tests_dir, '01uni_multi/[result]', p.target), 'rb').read())
+
+    def test_apply_async(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '01uni_multi'), treeroot)
+        pto = patch.PatchSet()
+        finished = []
+        task = pto.parse_async(open(join(tests_dir, '01uni_multi/01uni_multi.patch'), 'rb'),
+                               callback=finished.append)
+        self.assert_(task.result())
+        self.assertEqual(finished, [task])
+        self.assertEqual(task.processed, len(pto))
+
+        task = pto.apply_async(root=treeroot, chunksize=2)
+        self.assert_(task.wait(60))
+        self.assert_(task.done() and task.result())
+        self.assertFalse(task.cancel())
+        for p in pto:
+          self.assertEqual(open(join(treeroot, p.target), 'rb').read(),
+                           open(join(tests_dir, '01uni_multi/[result]', p.target), 'rb').read())
+
+        self.assertFalse(pto.apply_async(root=join(self.tmpdir, 'missing')).result())
+
+    def test_apply_async_cancel(self):
+        treeroot = join(self.tmpdir, 'rootparent')
+        shutil.copytree(join(tests_dir, '01uni_multi'), treeroot)
+        pto = patch.fromfile(join(tests_dir, '01uni_multi/01uni_multi.patch'))
+        reached, gate = threading.Event(), threading.Event()
+        class GatedList(list):
+          def __iter__(self):
+            for i, p in enumerate(list.__iter__(self)):
+              if i == 1:
+                reached.set()
+                gate.wait()
+              yield p
+        pto.items = GatedList(pto.items)
+
+        before = open(join(treeroot, 'updatedlg.cpp'), 'rb').read()
+        task = pto.apply_async(root=treeroot, atomic=True, chunksize=1)
+        reached.wait()
+        self.assert_(task.cancel())
+        gate.set()
+        self.assertRaises(patch.PatchCancelled, task.result)
+        self.assert_(task.cancelled())
+        self.assertEqual(task.processed, 1)
+        # first file was staged and rolled back
+        self.assertEqual(open(join(treeroot, 'updatedlg.cpp'), 'rb').read(), before)
+
+    def test_async_callback_error(self):
+        messages = []
+        class Recorder(logging.Handler):
+          def emit(self, record):
+            if record.exc_info:
+              messages.append((record.getMessage(), record.exc_info[0]))
+        def callback(task):
+          raise ValueError("broken callback")
+        handler = Recorder()
+        patch.logger.addHandler(handler)
+        try:
+          pto = patch.PatchSet()
+          task = pto.parse_async(StringIO(""), callback=callback)
+          task._thread.join()
+        finally:
+          patch.logger.removeHandler(handler)
+        self.assertEqual(messages, [("callback of PatchTask failed", ValueError)])
+        # the task itself is not affected
+        self.assertEqual(task.result(), True)
+
+    def test_apply_cache(self):
+        self.tmpcopy(['03trail_fname.patch', '03trail_fname.from'])
+        pto = patch.fromfile('03trail_fname.patch')
+        cachefile = join(self.tmpdir, 'patchcache.json')
+        cache = patch.PatchCache(cachefile)
+        self.assert_(pto.apply(cache=cache))
+        cache.save()
+
+        # known outcome for unchanged file is used without reading it
+        cache = patch.PatchCache(cachefile)
+        def noread(filename):
+          self.fail("%s was read" % filename)
+        pto.linetable = noread
+        self.assert_(pto.apply(cache=cache))
+        self.assertEqual(cache.hits, 1)
+        del pto.linetable
+
+        open('03trail_fname.from', 'ab').write('conflict\n')
+        os.utime('03trail_fname.from', (0, 0))
+        self.assert_(pto.apply(cache=cache))
+        self.assertEqual(cache.hits, 1)
+        open('03trail_fname.from', 'wb').write('conflict\n')
+        self.assertFalse(pto.apply(cache=cache))
+        pto.linetable = noread
+        self.assertFalse(pto.apply(cache=cache))
+        self.assertEqual(cache.hits, 2)
+
+    def test_write_hunks_matches_patch_stream(self):
+        self.tmpcopy(['01uni_multi/01uni_multi.patch',
+                      '01uni_multi/updatedlg.cpp'])
+        pto = patch.fromfile('01uni_multi.patch')
+        p = [x for x in pto.items if x.target.endswith('updatedlg.cpp')][0]
+        expected = ''.join(pto.patch_stream(open('updatedlg.cpp', 'rb'),
+                                            p.hunks))
+        self.assert_(pto.write_hunks('updatedlg.cpp', 'out.cpp', p.hunks,
+                                     root=self.tmpdir))
+        self.assertEqual(open('out.cpp', 'rb').read(), expected)
+
+    gitpatch = """\
+diff --git a/old.txt b/new.txt
+similarity index 100%
+rename from old.txt
+rename to new.txt
+diff --git a/run.sh b/run.sh
+old mode 100644
+new mode 100755
+diff --git a/empty.txt b/empty.txt
+new file mode 100644
+index 0000000..e69de29
+diff --git a/gone.txt b/gone.txt
+deleted file mode 100644
+index 814f4a4..0000000
+--- a/gone.txt
++++ /dev/null
+@@ -1,2 +0,0 @@
+-one
+-two
+diff --git a/added.txt b/added.txt
+new file mode 100755
+index 0000000..ce01362
+--- /dev/null
++++ b/added.txt
+@@ -0,0 +1 @@
++hello
+diff --git a/moved.txt b/dir/moved.txt
+similarity index 67%
+rename from moved.txt
+rename to dir/moved.txt
+index 2e09960..bb3d0ab 100644
+--- a/moved.txt
++++ b/dir/moved.txt
+@@ -1,2 +1,2 @@
+ keep
+-old
++new
+"""
+
+    def test_git_extended_headers(self):
+        pto = patch.fromstring(self.gitpatch)
+        self.assertEqual((pto.errors, pto.warnings, pto.type), (0, 0, patch.GIT))
+        self.assertEqual([(p.source, p.target, p.rename, p.oldmode, p.newmode, p.similarity)
+                          for p in pto],
+                         [('old.txt', 'new.txt', True, None, None, 100),
+                          ('run.sh', 'run.sh', False, 0100644, 0100755, None),
+                          (patch.DEVNULL, 'empty.txt', False, None, 0100644, None),
+                          ('gone.txt', patch.DEVNULL, False, 0100644, None, None),
+                          (patch.DEVNULL, 'added.txt', False, None, 0100755, None),
+                          ('moved.txt', 'dir/moved.txt', True, None, None, 67)])
+        self.assertEqual(pto.diffstat_dict()['files'][3]['name'], 'gone.txt')
+
+    def test_git_binary(self):
+        binary = ("diff --git a/img.png b/img.png\nnew file mode 100644\n"
+                  "index 0000000..b5b0d1e\n"
+                  "Binary files /dev/null and b/img.png differ\n"
+                  "diff --git a/a.png b/b.png\nsimilarity index 90%\n"
+                  "rename from a.png\nrename to b.png\nindex 2e09960..bb3d0ab\n"
+                  "GIT binary patch\nliteral 5\nMc${NkvXXu0mjf1CLV!1poj5\n\n"
+                  "literal 5\nMc${NkvXXu0mjf1CLV!1poj5\n\n")
+        self.assertFalse(patch.fromstring(binary))
+        # other patches are parsed, but the patch set is not valid
+        pto = patch.PatchSet()
+        self.assertFalse(pto.parse(StringIO(binary + self.gitpatch)))
+        self.assertEqual(pto.errors, 2)
+        self.assertEqual([p.target for p in pto],
+                         [p.target for p in patch.fromstring(self.gitpatch)])
+
+    def test_apply_git_extended_headers(self):
+        def tree():
+            return dict((join(d, f)[len(self.tmpdir)+1:], open(join(d, f), 'rb').read())
+                        for d, dirs, files in os.walk(self.tmpdir) for f in files)
+        for name, data in (('old.txt', 'x\n'), ('run.sh', 'exit\n'), ('gone.txt', 'one\ntwo\n'),
+                           ('moved.txt', 'keep\nold\n')):
+            open(name, 'wb').write(data)
+        os.chmod('run.sh', 0644)
+        before = tree()
+        pto = patch.fromstring(self.gitpatch)
+        for atomic in (False, True):
+            self.assert_(pto.apply(atomic=atomic))
+            self.assertEqual(tree(), {'new.txt': 'x\n', 'run.sh': 'exit\n', 'empty.txt': '',
+                                      'added.txt': 'hello\n',
+                                      join('dir', 'moved.txt'): 'keep\nnew\n'})
+            if os.name != 'nt':
+                self.assertEqual(os.stat('run.sh').st_mode & 0777, 0755)
+                self.assertEqual(os.stat('added.txt').st_mode & 0777, 0755)
+            # applying again finds everything patched
+            self.assert_(pto.apply(atomic=atomic))
+            self.assert_(pto.revert(atomic=atomic))
+            self.assertEqual(tree(), before)
+            if os.name != 'nt':
+                self.assertEqual(os.stat('run.sh').st_mode & 0777, 0644)
+
+    def test_apply_atomic_git_staging(self):
+        def rename(old, new):
+            return patch.fromstring("diff --git a/%s b/%s\nsimilarity index 100%%\n"
+                                    "rename from %s\nrename to %s\n" % (old, new, old, new))
+        open('a.txt', 'wb').write('x\n')
+        # renamed file is edited under its new name
+        pto = rename('a.txt', 'b.txt')
+        pto.items += patch.fromstring("--- b.txt\n+++ b.txt\n@@ -1 +1 @@\n-x\n+y\n").items
+        self.assert_(pto.apply(atomic=True))
+        self.assertEqual(os.listdir(self.tmpdir), ['b.txt'])
+        self.assertEqual(open('b.txt', 'rb').read(), 'y\n')
+
+        # plain renames move the file instead of copying it
+        inode = os.stat('b.txt').st_ino
+        self.assert_(rename('b.txt', join('dir', 'c.txt')).apply(atomic=True))
+        self.assertEqual(os.stat(join('dir', 'c.txt')).st_ino, inode)
+
+        # removed file can't be patched by a later patch of the set
+        pto = rename(join('dir', 'c.txt'), 'd.txt')
+        pto.items += patch.fromstring("--- dir/c.txt\n+++ dir/c.txt\n"
+                                      "@@ -1 +1 @@\n-y\n+z\n").items
+        self.assertFalse(pto.apply(atomic=True))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['dir'])
+        self.assertEqual(os.listdir('dir'), ['c.txt'])
+        self.assertEqual(open(join('dir', 'c.txt'), 'rb').read(), 'y\n')
+
+    def test_apply_jobs_new_directory(self):
+        pto = patch.fromstring(''.join(
+            "diff --git a/new/%d.txt b/new/%d.txt\nnew file mode 100644\n"
+            "--- /dev/null\n+++ b/new/%d.txt\n@@ -0,0 +1 @@\n+%d\n" % (n, n, n, n)
+            for n in range(16)))
+        self.assert_(pto.apply(jobs=8))
+        self.assertEqual(len(os.listdir('new')), 16)
+        # directory created by other worker after the check is fine
+        exists = patch.exists
+        patch.exists = lambda path: False
+        try:
+          pto._makedirs(join('new', '0.txt'))
+        finally:
+          patch.exists = exists
+        self.assertRaises(OSError, pto._makedirs, join('new', '0.txt', 'sub', 'x'))
+
+    def test_apply_jobs_git_rename_chain(self):
+        def rename(old, new):
+            return patch.fromstring("diff --git a/%s b/%s\nsimilarity index 100%%\n"
+                                    "rename from %s\nrename to %s\n" % (old, new, old, new))
+        def edit(name, old, new):
+            return patch.fromstring("--- %s\n+++ %s\n@@ -1 +1 @@\n-%s\n+%s\n"
+                                    % (name, name, old, new))
+        # a.txt takes the place of b.txt renamed before, which joins
+        # groups of both files into one
+        pto = edit('a.txt', 'a', 'a2')
+        for p in (rename('b.txt', 'c.txt'), rename('a.txt', 'b.txt'),
+                  edit('b.txt', 'a2', 'a3'), edit('c.txt', 'b', 'b2')):
+            pto.items += p.items
+
+        calls = []
+        apply_patch = pto._apply_patch
+        def recorded(p, i, *args):
+            if i == 1:
+                time.sleep(0.1)  # let other workers run ahead, if any
+            calls.append(i)
+            return apply_patch(p, i, *args)
+        pto._apply_patch = recorded
+        for atomic in (False, True):
+            open('a.txt', 'wb').write('a\n')
+            open('b.txt', 'wb').write('b\n')
+            del calls[:]
+            self.assert_(pto.apply(atomic=atomic, jobs=3))
+            self.assertEqual(calls, range(5))
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), ['b.txt', 'c.txt'])
+            self.assertEqual(open('b.txt', 'rb').read(), 'a3\n')
+            self.assertEqual(open('c.txt', 'rb').read(), 'b2\n')
+            os.unlink('b.txt')
+            os.unlink('c.txt')
+
+    def test_apply_buffers_git_extended_headers(self):
+        files = {'old.txt': 'x\n', 'run.sh': 'exit\n', 'gone.txt': 'one\ntwo\n',
+                 'moved.txt': 'keep\nold\n'}
+        pto = patch.fromstring(self.gitpatch)
+        result = pto.apply_buffers(files)
+        self.assertEqual(result, {'old.txt': None, 'new.txt': 'x\n', 'run.sh': 'exit\n',
+                                  'empty.txt': '', 'gone.txt': None, 'added.txt': 'hello\n',
+                                  'moved.txt': None, 'dir/moved.txt': 'keep\nnew\n'})
+        # applying again finds everything patched
+        self.assertEqual(pto.apply_buffers(result), result)
+        reverted = pto.reversed().apply_buffers(result)
+        self.assertEqual(dict((k, v) for k, v in reverted.items() if v is not None), files)
+        self.assertFalse(pto.apply_buffers(dict(files, **{'gone.txt': 'changed\n'})))
+
+    def test_can_patch_git_extended_headers(self):
+        open('gone.txt', 'wb').write('one\ntwo\n')
+        open('moved.txt', 'wb').write('keep\nold\n')
+        pto = patch.fromstring(self.gitpatch)
+        self.assert_(abspath(patch.DEVNULL) not in pto.sourceindex())
+        result = pto.can_patch_all()
+        self.assertEqual(sorted(result), ['gone.txt', 'moved.txt', 'old.txt', 'run.sh'])
+        self.assertEqual((result['gone.txt'], result['moved.txt'], result['old.txt']),
+                         (patch.APPLIES, patch.APPLIES, None))
+        self.assertEqual(pto.can_patch(patch.DEVNULL), None)
+        open('gone.txt', 'wb').write('one\n')
+        self.assertEqual(pto.can_patch_all(['gone.txt'])['gone.txt'], patch.CONFLICT)
+
+    def test_line_ends_profile(self):
+        pto = patch.fromstring("--- a\n+++ a\n@@ -1,2 +1,3 @@\n+new\n one\n-two\n+2\n")
+        hunks = pto.items[0].hunks
+        # line ends of the source win if they are all the same
+        for source, expected in (("one\r\ntwo\r\n", "new\r\none\r\n2\r\n"),
+                                 ("one\r\ntwo\n", "new\none\n2\n"),
+                                 ("one\ntwo\r", "new\none\n2\n")):
+            self.assertEqual(''.join(pto.patch_stream(StringIO(source), hunks)), expected)
+            open('source', 'wb').write(source)
+            self.assert_(pto.write_hunks('source', 'target', hunks))
+            self.assertEqual(open('target', 'rb').read(), expected)
+        # CRLF split between blocks of the scan
+        self.assertEqual(patch.lineend(StringIO("a" * 65535 + "\r\nc\r\n")), "\r\n")
+
     def test_apply_strip(self):
         treeroot = join(self.tmpdir, 'rootparent')
         shutil.copytree(join(tests_dir, '06nested'), treeroot)
@@ -355,6 +993,215 @@ class TestPatchApply(unittest.TestCase):
           p.target = 'nasty/prefix/' + p.target
         self.assert_(pto.apply(strip=2, root=treeroot))
 
+class TestPatchApplyBuffers(unittest.TestCase):
+    def read(self, path):
+        fp = open(join(tests_dir, path), 'rb')
+        try:
+          return fp.read()
+        finally:
+          fp.close()
+
+    def test_apply_buffers(self):
+        pto = patch.fromfile(join(tests_dir, '01uni_multi/01uni_multi.patch'))
+        files = dict((p.source, self.read('01uni_multi/' + p.source)) for p in pto)
+        # file-like objects are supported as well
+        files['conf.h'] = open(join(tests_dir, '01uni_multi/conf.h'), 'rb')
+        result = pto.apply_buffers(files)
+        files['conf.h'].close()
+        self.assertEqual(sorted(result), sorted(p.target for p in pto))
+        for name, data in result.items():
+          self.assertEqual(data, self.read('01uni_multi/[result]/' + name))
+
+        # applying again finds everything patched
+        self.assertEqual(pto.apply_buffers(result), result)
+
+    def test_apply_buffers_fails_on_missing_or_conflicting_file(self):
+        pto = patch.fromfile(join(tests_dir, '03trail_fname.patch'))
+        self.assertFalse(pto.apply_buffers({}))
+        self.assertFalse(pto.apply_buffers({'03trail_fname.from': 'conflict\n'}))
+
+class TestCompose(unittest.TestCase):
+    source = "".join(c + "\n" for c in "abcdefghij")
+    first = """\
+--- f
++++ f
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+@@ -8,2 +8,3 @@
+ h
++X
+ i
+"""
+    second = """\
+--- f
++++ f
+@@ -3,3 +3,3 @@
+ C
+-d
++D
+ e
+@@ -10,2 +10,2 @@
+ i
+-j
++J
+--- other
++++ other
+@@ -1 +1 @@
+-old
++new
+"""
+
+    def test_compose(self):
+        first, second = patch.fromstring(self.first), patch.fromstring(self.second)
+        composed = patch.compose([first, second])
+        self.assertEqual(composed.errors, 0)
+        self.assertEqual([p.source for p in composed], ['f', 'other'])
+        hunks = composed.items[0].hunks
+        self.assertEqual([(h.startsrc, h.linessrc, h.starttgt, h.linestgt) for h in hunks],
+                         [(2, 4, 2, 4), (8, 3, 8, 4)])
+        self.assertEqual(hunks[0].text, [' b\n', '-c\n', '+C\n', '-d\n', '+D\n', ' e\n'])
+        self.assertEqual(composed.items[0].insertions, 4)
+
+        files = dict(f=self.source, other='old\n')
+        self.assertEqual(composed.apply_buffers(files),
+                         patch.fromstring(self.first + self.second).apply_buffers(files))
+        # inputs are left as they are
+        self.assertEqual(first.items[0].hunks[1].starttgt, 8)
+        self.assertEqual(second.items[0].hunks[0].startsrc, 3)
+
+    def test_compose_conflict(self):
+        # second patch expects line changed by the first one
+        conflicting = patch.fromstring(self.first.replace('+C', '+c').replace('-c', '-C'))
+        composed = patch.compose([conflicting, patch.fromstring(self.second)])
+        self.assertEqual(composed.errors, 1)
+        self.assertEqual([p.source for p in composed], ['f', 'f', 'other'])
+
+        # changes that cancel each other out leave no hunk
+        composed = patch.compose([patch.fromstring(self.first),
+                                  patch.fromstring(self.first).reversed()])
+        self.assertEqual(composed.errors, 0)
+        self.assertEqual(composed.items[0].hunks, [])
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix=self.__class__.__name__)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_diffhunks(self):
+        a = ['%d\n' % i for i in range(20)]
+        b = a[:2] + ['new\n'] + a[2:15] + a[16:19] + ['19']
+        hunks = patch.diffhunks(a, b)
+        self.assertEqual([(h.startsrc, h.linessrc, h.starttgt, h.linestgt) for h in hunks],
+                         [(1, 5, 1, 6), (13, 8, 14, 7)])
+        self.assertEqual(hunks[0].text, [' 0\n', ' 1\n', '+new\n', ' 2\n', ' 3\n', ' 4\n'])
+        self.assertEqual(hunks[1].text[-3:],
+                         ['-19\n', '+19', '\\ No newline at end of file\n'])
+        self.assertEqual(len(patch.diffhunks(a, b, context=10)), 1)
+        self.assertEqual(patch.diffhunks(a, a), [])
+
+    def test_diffhunks_many_changes(self):
+        a = ['%d\n' % i for i in range(20000)]
+        b = a[:]
+        for i in range(0, 20000, 7):
+            b[i] = 'changed\n'
+        hunks = patch.diffhunks(a, b, context=0)
+        self.assertEqual(len(hunks), len(range(0, 20000, 7)))
+        self.assertEqual(sum(h.linessrc for h in hunks), len(hunks))
+        # search is cut short for very different lines, result is valid
+        a = [str(i % 5) for i in range(600)]
+        b = [str(i % 7) for i in range(600)]
+        for maxcost in (1, 16, 256):
+            matches = patch._myers(a, b, maxcost)
+            self.assert_(matches)
+            self.assertEqual(matches, sorted(matches))
+            self.assertEqual(sorted(j for i, j in matches), [j for i, j in matches])
+            self.assert_(all(a[i] == b[j] for i, j in matches))
+
+    def test_frombuffers(self):
+        old = {'same': 'a\n', 'changed': 'a\nb\nc\n', 'deleted': 'a\n',
+               'binary': 'a\0'}
+        new = {'same': 'a\n', 'changed': 'a\nB\nc\n', 'created': StringIO('x\r\ny\r\n'),
+               'binary': 'b\0'}
+        pto = patch.frombuffers(old, new)
+        self.assertEqual(pto.warnings, 1)
+        self.assertEqual([(p.source, p.target) for p in pto],
+                         [('changed', 'changed'), (patch.DEVNULL, 'created'),
+                          ('deleted', patch.DEVNULL)])
+        self.assertEqual(pto.items[0].hunks[0].text, [' a\n', '-b\n', '+B\n', ' c\n'])
+        self.assertEqual(pto.items[1].hunkends, dict(lf=0, crlf=2, cr=0))
+        self.assertEqual((pto.items[1].insertions, pto.items[2].deletions), (2, 1))
+
+    def test_frombuffers_roundtrip(self):
+        old = {'eol': 'a\nb', 'noeol': 'a\nb\n', 'ins': 'a\nb\nc\n',
+               'deleted': 'a\nb\n'}
+        new = {'eol': 'a\nc', 'noeol': 'a\nb', 'ins': 'a\nx\nb\nc\ny\n',
+               'created': 'x\ny'}
+        for context in (0, 3):
+            pto = patch.frombuffers(old, new, context)
+            expected = dict(new, deleted=None)
+            del expected['ins']
+            result = pto.apply_buffers(old)
+            self.assertEqual(result.pop('ins'), new['ins'])
+            self.assertEqual(result, expected)
+
+            # plain diff without git headers goes through disk apply
+            for name, data in old.items():
+                f = open(join(self.tmpdir, name), 'wb')
+                f.write(data)
+                f.close()
+            save_stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+              pto.dump()
+            finally:
+              dumped, sys.stdout = sys.stdout.getvalue(), save_stdout
+            self.assertEqual(dumped.count('\\ No newline at end of file\n'), 4)
+            self.assert_(patch.fromstring(dumped).apply(root=self.tmpdir))
+            self.assertEqual(dict((name, open(join(self.tmpdir, name), 'rb').read())
+                                  for name in os.listdir(self.tmpdir)), new)
+            for name in new:
+                os.unlink(join(self.tmpdir, name))
+
+    def test_fromtrees(self):
+        old, new = join(self.tmpdir, 'old'), join(self.tmpdir, 'new')
+        shutil.copytree(join(tests_dir, '06nested'), old,
+                        ignore=shutil.ignore_patterns('[[]result]', '06nested.patch'))
+        shutil.copytree(join(tests_dir, '06nested/[result]'), new)
+        pto = patch.fromtrees(old, new, jobs=2)
+        self.assertEqual([p.source for p in pto],
+                         [p.source for p in patch.fromfile(join(tests_dir, '06nested/06nested.patch'))])
+
+        # dumped diff is parsed and applied back
+        save_stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+          pto.dump()
+        finally:
+          dumped, sys.stdout = sys.stdout.getvalue(), save_stdout
+        self.assert_(patch.fromstring(dumped).apply(root=old))
+        self.assertEqual(len(patch.fromtrees(old, new)), 0)
+
+class TestBenchmark(unittest.TestCase):
+    def test_workloads(self):
+        for name in sorted(benchmark.workloads):
+            result = benchmark.measure(name, scale=0.001)
+            self.assertEqual(sorted(result), sorted(benchmark.phases + ('memory',)))
+
+    def test_compare(self):
+        def result(seconds):
+            r = dict((phase, dict(seconds=0.001, mbps=1.0)) for phase in benchmark.phases)
+            r['apply']['seconds'] = seconds
+            r['memory'] = 10.0
+            return r
+        baselines = dict(bigfile=result(1.0))
+        self.assertEqual(benchmark.compare(dict(bigfile=result(1.2)), baselines), [])
+        self.assertEqual(benchmark.compare(dict(bigfile=result(2.0), other=result(9.0)),
+                                           baselines),
+                         [('bigfile', 'apply', 2.0, 1.0)])
+
 class TestHelpers(unittest.TestCase):
     # unittest setting
     longMessage = True
@@ -16,9 +16,22 @@
 __author__ = "anatoly techtonik <techtonik@gmail.com>"
 __version__ = "1.14dev"
 
+from array import array
 import copy
+import errno
+import hashlib
+from itertools import izip
+import json
 import logging
+import marshal
+import mmap
+from multiprocessing.pool import Pool, ThreadPool
 import re
+import string
+import sys
+import tempfile
+import threading
+import time
 # cStringIO doesn't support unicode in 2.5
 from StringIO import StringIO
 import urllib2
@@ -55,6 +68,25 @@ class NullHandler(logging.Handler):
 
 logger.addHandler(NullHandler())
 
+class HoldingFilter(logging.Filter):
+  """ Holds back records logged by threads that have a list
+      assigned to `local.records`, so that output of parallel
+      workers can be emitted in deterministic order later on
+  """
+  def __init__(self):
+    logging.Filter.__init__(self)
+    self.local = threading.local()
+
+  def filter(self, record):
+    records = getattr(self.local, 'records', None)
+    if records is None:
+      return True
+    records.append(record)
+    return False
+
+holding = HoldingFilter()
+logger.addFilter(holding)
+
 #------------------------------------------------
 # Constants for Patch/PatchSet types
 
@@ -66,6 +98,24 @@ SVN = SUBVERSION = "svn"
 # Patches of different type
 MIXED = MIXED = "mixed"
 
+#------------------------------------------------
+# Constants for hunk validation status
+
+APPLIES = "applies"    # source lines match, hunk can be applied
+APPLIED = "applied"    # target lines match, hunk is already applied
+CONFLICT = "conflict"  # neither source nor target lines match
+
+#------------------------------------------------
+# Line ends of hunk lines are stored as index into this tuple
+
+LINEENDS = ('', '\n', '\r\n', '\r')
+
+# translation table to swap added and removed lines
+REVERSEDOPS = string.maketrans('+-', '-+')
+
+# source of created files and target of deleted ones
+DEVNULL = "/dev/null"
+
 
 #------------------------------------------------
 # Helpers (these could come with Python stdlib)
@@ -112,17 +162,25 @@ def xstrip(filename):
 #-----------------------------------------------
 # Main API functions
 
-def fromfile(filename):
+def fromfile(filename, jobs=None, mapped=False):
   """ Parse patch file. If successful, returns
       PatchSet() object. Otherwise returns False.
+      Big files may be parsed by `jobs` processes, or
+      through memory map if `mapped` is True (see
+      `PatchSet.parse_mapped()`), which ignores `jobs`.
+      The map is released by `PatchSet.close()`.
   """
   patchset = PatchSet()
-  debug("reading %s" % filename)
+  debug("reading %s", filename)
   fp = open(filename, "rb")
-  res = patchset.parse(fp)
+  if mapped:
+    res = patchset.parse_mapped(fp)
+  else:
+    res = patchset.parse(fp, jobs)
   fp.close()
   if res == True:
     return patchset
+  patchset.close()
   return False
 
 
@@ -147,7 +205,560 @@ def fromurl(url):
   return False
 
 
+def fromcompiled(data, **params):
+  """ Load PatchSet from string returned by `PatchSet.compile()`
+      without parsing. Placeholders like {name} in filenames and
+      hunk lines are replaced with value of keyword argument `name`,
+      placeholders without value are left as they are.
+  """
+  version, name, pstype, errors, warnings, patches = marshal.loads(data)
+  if version != PatchSet.compiled_version:
+    raise ValueError("compiled patch set has unsupported version %r" % (version,))
+  ps = PatchSet()
+  ps.name = name
+  ps.type = pstype
+  ps.errors = errors
+  ps.warnings = warnings
+  for state in patches:
+    p = Patch()
+    (source, target, p.type, p.header, p.hunkends, p.insertions, p.deletions, p.delta,
+     p.rename, p.oldmode, p.newmode, p.similarity, hunks) = state
+    p.source = substitute(source, params)
+    p.target = substitute(target, params)
+    changed = False
+    for hstate in hunks:
+      # see Hunk.__getstate__() - lines are usually joined into one string
+      lines = hstate[7]
+      if isinstance(lines, str):
+        lines = substitute(lines, params)
+      else:
+        lines = [substitute(line, params) for line in lines]
+      changed = changed or lines != hstate[7]
+      h = Hunk()
+      h.__setstate__(hstate[:7] + (lines,) + hstate[8:])
+      p.hunks.append(h)
+    if changed:
+      p.recount()
+    ps.items.append(p)
+  return ps
+
+
+def frombuffers(old, new, context=3):
+  """ Compare files in memory and return PatchSet that changes `old`
+      contents into `new` ones. Both map file names to contents, given
+      as string or file-like object (like for `PatchSet.apply_buffers()`).
+      Files missing in `old` are created, files missing in `new` deleted.
+      Hunks have `context` unchanged lines around changes.
+  """
+  def read(files, name):
+    data = files.get(name)
+    if hasattr(data, 'read'):
+      data = data.read()
+    return data
+  names = sorted(set(old) | set(new))
+  return _diffset(_diff_file((name, read(old, name), read(new, name), context))
+                  for name in names)
+
+
+def fromtrees(oldroot, newroot, context=3, jobs=None):
+  """ Compare directory trees and return PatchSet that changes files in
+      `oldroot` into files in `newroot`, named by their path relative to
+      the root. Files are compared by a pool of `jobs` processes if it is
+      given. Binary files are skipped with a warning.
+      Other arguments are the same as for `frombuffers()`.
+  """
+  paths = {}  # relative name -> [old path, new path]
+  for side, root in enumerate((oldroot, newroot)):
+    for dirpath, dirnames, filenames in os.walk(root):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        name = os.path.relpath(path, root).replace(os.sep, '/')
+        paths.setdefault(name, [None, None])[side] = path
+  tasks = [(name, oldpath, newpath, context)
+           for name, (oldpath, newpath) in sorted(paths.items())]
+
+  if not jobs or jobs < 2:
+    return _diffset(_diff_paths(task) for task in tasks)
+  pool = Pool(jobs)
+  try:
+    return _diffset(pool.imap(_diff_paths, tasks, chunksize=16))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def compose(patchsets):
+  """ Fold PatchSets, which are applied one after another, into a single
+      PatchSet that reads and writes every file only once. Patches for
+      the same file are merged - hunks of later patches are rebased onto
+      lines of earlier ones, and hunks that overlap are combined. If
+      overlapping hunks don't agree on the lines they share, the patches
+      can't be merged - this is counted as an error, and the later patch
+      is kept as a separate item after the earlier one.
+      Patches are shared with the given sets, merged ones are new.
+  """
+  ps = PatchSet()
+  # name of every file patched so far -> index of its patch in ps.items
+  current = {}
+  for patchset in patchsets:
+    ps.errors += patchset.errors
+    ps.warnings += patchset.warnings
+    if ps.type is None:
+      ps.type = patchset.type
+    elif ps.type != patchset.type:
+      ps.type = MIXED
+
+    for q in patchset.items:
+      i = None
+      if q.source != DEVNULL:
+        i = current.get(q.source)
+        if i is None and not q.rename:
+          i = current.get(q.target)
+      merged = None
+      if i is not None:
+        p = ps.items[i]
+        merged = _compose_patch(p, q)
+        if merged is None:
+          warning("can't compose patches for %s - overlapping hunks conflict", q.source)
+          ps.errors += 1
+        for name in (p.source, p.target):
+          if current.get(name) == i:
+            del current[name]
+      if merged is None:
+        i = len(ps.items)
+        ps.items.append(q)
+        merged = q
+      else:
+        ps.items[i] = merged
+      for name in (merged.source, merged.target):
+        if name != DEVNULL and (name == merged.target or not merged.rename):
+          current[name] = i
+
+  # files created and deleted again are left alone
+  ps.items = [p for p in ps.items if p.source != DEVNULL or p.target != DEVNULL]
+  return ps
+
+
+def _compose_patch(p, q):
+  """ return Patch with the changes of Patch `p` followed by Patch `q`,
+      or None if their hunks conflict
+  """
+  hunks = _compose_hunks(p.hunks, q.hunks)
+  if hunks is None:
+    return None
+  c = Patch()
+  c.source = p.source
+  c.target = q.target
+  c.header = list(p.header)
+  c.type = p.type
+  c.hunks = hunks
+  c.hunkends = dict(lf=0, crlf=0, cr=0)
+  for h in hunks:
+    c.hunkends["lf"] += h.ends.count(1)
+    c.hunkends["crlf"] += h.ends.count(2)
+    c.hunkends["cr"] += h.ends.count(3)
+  c.recount()
+
+  c.rename = ((p.rename or q.rename) and c.source != c.target
+              and DEVNULL not in (c.source, c.target))
+  if p.newmode is not None:
+    c.oldmode = p.oldmode
+  else:
+    c.oldmode = q.oldmode
+  if q.newmode is not None:
+    c.newmode = q.newmode
+  else:
+    c.newmode = p.newmode
+  if c.oldmode is not None and c.oldmode == c.newmode:
+    c.oldmode = c.newmode = None
+  return c
+
+
+def _compose_hunks(first, second):
+  """ return list of new hunks that change lines like `first` hunks
+      followed by `second` ones, or None if they can't be combined.
+      Hunks of both lists are matched by their lines in the file
+      between the two patches - target lines of `first` and source
+      lines of `second`. Hunks that overlap or touch there are merged,
+      others are copied with their line numbers rebased.
+  """
+  spans = []
+  for side, hunks in enumerate((first, second)):
+    for h in hunks:
+      if h.invalid:
+        return None
+      if side == 0:
+        start, end = _span(h.starttgt, h.linestgt)
+      else:
+        start, end = _span(h.startsrc, h.linessrc)
+      spans.append((start, side, end, h))
+  spans.sort(key=lambda span: span[:2])
+
+  # [start, end, spans] of runs of overlapping spans
+  groups = []
+  for span in spans:
+    if groups and span[0] <= groups[-1][1]:
+      groups[-1][1] = max(groups[-1][1], span[2])
+      groups[-1][2].append(span)
+    else:
+      groups.append([span[0], span[2], [span]])
+
+  result = []
+  # lines added by first and second hunks before current group
+  addedfirst = addedsecond = 0
+  for start, end, group in groups:
+    sides = set(span[1] for span in group)
+    if sides == set([0]):
+      for pos, side, _, h in group:
+        result.append(_rebased(h, h.startsrc, _start(pos + addedsecond, h.linestgt)))
+        addedfirst += h.linestgt - h.linessrc
+    elif sides == set([1]):
+      for pos, side, _, h in group:
+        result.append(_rebased(h, _start(pos - addedfirst, h.linessrc), h.starttgt))
+        addedsecond += h.linestgt - h.linessrc
+    else:
+      h = _merged(start, end, group)
+      if h is None:
+        return None
+      h.startsrc = _start(start - addedfirst, h.linessrc)
+      h.starttgt = _start(start + addedsecond, h.linestgt)
+      addedfirst += end - start - h.linessrc
+      addedsecond += h.linestgt - (end - start)
+      # changes may cancel each other out
+      sides = ([], [])
+      for op, line, lineend in izip(h.ops, h.lines, h.ends):
+        if op in ' -':
+          sides[0].append((line, lineend))
+        if op in ' +':
+          sides[1].append((line, lineend))
+      if sides[0] != sides[1]:
+        result.append(h)
+  return result
+
+
+def _span(start, count):
+  """ return (start, end) of hunk lines as zero-based slice - start
+      of empty hunk is the number of line before it
+  """
+  if count:
+    start -= 1
+  return start, start + count
+
+def _start(pos, count):
+  """ reverse of `_span()` - return hunk start for slice position """
+  if count:
+    return pos + 1
+  return pos
+
+
+def _rebased(h, startsrc, starttgt):
+  """ return copy of hunk `h` with new start lines """
+  c = Hunk()
+  c.startsrc, c.linessrc = startsrc, h.linessrc
+  c.starttgt, c.linestgt = starttgt, h.linestgt
+  c.desc = h.desc
+  c.ops = array('c', h.ops.tostring())
+  c.lines = list(h.lines)
+  c.ends = array('B', h.ends.tostring())
+  return c
+
+
+def _merged(start, end, group):
+  """ return single hunk with changes of all overlapping hunks in `group`,
+      or None if they don't agree on the lines between `start` and `end`
+      (see `_compose_hunks()`). Start lines are left for the caller.
+  """
+  # [op, line, end, markers] of every line between the patches, as seen
+  # by first and second hunks, and of lines removed by first and added
+  # by second hunks - keyed by (position of next line, side)
+  known = ([None] * (end - start), [None] * (end - start))
+  gaps = {}
+  for pos, side, _, h in group:
+    pos -= start
+    gap = '-+'[side]
+    item = None
+    for op, line, lineend in izip(h.ops, h.lines, h.ends):
+      if op == '\\':
+        # "\ No newline at end of file" stays with its line
+        if item:
+          item[3].append((op, line, lineend))
+        continue
+      item = [op, line, lineend, []]
+      if op == gap:
+        gaps.setdefault((pos, side), []).append(item)
+      else:
+        known[side][pos] = item
+        pos += 1
+
+  c = Hunk()
+  c.desc = group[0][3].desc
+  def add(op, item):
+    for op, line, lineend in [(op, item[1], item[2])] + item[3]:
+      c.ops.append(op)
+      c.lines.append(line)
+      c.ends.append(lineend)
+
+  for pos in xrange(end - start + 1):
+    for item in gaps.get((pos, 0), []) + gaps.get((pos, 1), []):
+      add(item[0], item)
+    if pos == end - start:
+      break
+    a, b = known[0][pos], known[1][pos]
+    if a and b and a[1] != b[1]:
+      debug("line %d differs in overlapping hunks", start + pos + 1)
+      return None
+    aop = a and a[0] or ' '
+    bop = b and b[0] or ' '
+    if aop == '+' and bop == '-':
+      continue  # added by first and removed by second
+    add(aop == '+' and '+' or bop, a or b)
+
+  c.linessrc = c.ops.count(' ') + c.ops.count('-')
+  c.linestgt = c.ops.count(' ') + c.ops.count('+')
+  return c
+
+
+def diffhunks(a, b, context=3):
+  """ Compare lists of lines `a` and `b`, which include their line ends,
+      and return list of Hunks that change `a` into `b`, with `context`
+      unchanged lines around changes. Lines are interned as numbers
+      before they are compared.
+  """
+  ids = {}
+  x = [ids.setdefault(line, len(ids)) for line in a]
+  y = [ids.setdefault(line, len(ids)) for line in b]
+  n, m = len(x), len(y)
+
+  # common head and tail are cut off before searching
+  head = 0
+  while head < n and head < m and x[head] == y[head]:
+    head += 1
+  tail = 0
+  while tail < n - head and tail < m - head and x[n-1-tail] == y[m-1-tail]:
+    tail += 1
+  matches = [(i + head, j + head) for i, j in _myers(x[head:n-tail], y[head:m-tail])]
+  matches = ([(i, i) for i in xrange(head)] + matches +
+             [(n - tail + i, m - tail + i) for i in xrange(tail)])
+
+  # (i1, i2, j1, j2) of changed slices between matching lines
+  changes = []
+  i = j = 0
+  for mi, mj in matches + [(n, m)]:
+    if mi > i or mj > j:
+      changes.append((i, mi, j, mj))
+    i, j = mi + 1, mj + 1
+
+  # changes closer than twice the context go into one hunk
+  groups = []
+  for change in changes:
+    if groups and change[0] - groups[-1][-1][1] <= 2 * context:
+      groups[-1].append(change)
+    else:
+      groups.append([change])
+
+  hunks = []
+  for group in groups:
+    i1 = max(group[0][0] - context, 0)
+    i2 = min(group[-1][1] + context, n)
+    j1 = group[0][2] - (group[0][0] - i1)
+    j2 = group[-1][3] + (i2 - group[-1][1])
+    h = Hunk()
+    h.startsrc, h.linessrc = _start(i1, i2 - i1), i2 - i1
+    h.starttgt, h.linestgt = _start(j1, j2 - j1), j2 - j1
+    lines = []
+    i = i1
+    for ci1, ci2, cj1, cj2 in group:
+      lines.extend(' ' + line for line in a[i:ci1])
+      lines.extend('-' + line for line in a[ci1:ci2])
+      lines.extend('+' + line for line in b[cj1:cj2])
+      i = ci2
+    lines.extend(' ' + line for line in a[i:i2])
+    for line in lines:
+      h.append(line)
+      if h.ends[-1] == 0:
+        h.append("\\ No newline at end of file\n")
+    hunks.append(h)
+  return hunks
+
+
+def _myers(a, b, maxcost=256):
+  """ return list of (i, j) positions of the longest common subsequence
+      of `a` and `b`, found by Myers' O(ND) difference algorithm in its
+      linear space form. Ranges are split at the middle of the shortest
+      edit path, until they differ only by insertions or deletions.
+
+      When a range needs more than `maxcost` rounds of the search, it is
+      split at the furthest point reached instead, so time stays bounded
+      for very different inputs, but the result may be longer than the
+      minimal edit script.
+  """
+  # lines missing on the other side never match - leave them out
+  ina, inb = set(a), set(b)
+  ai = [i for i, line in enumerate(a) if line in inb]
+  bj = [j for j, line in enumerate(b) if line in ina]
+  x = [a[i] for i in ai]
+  y = [b[j] for j in bj]
+
+  matches = []
+  ranges = [(0, len(x), 0, len(y))]
+  while ranges:
+    x0, x1, y0, y1 = ranges.pop()
+    while x0 < x1 and y0 < y1 and x[x0] == y[y0]:
+      matches.append((x0, y0))
+      x0 += 1
+      y0 += 1
+    while x0 < x1 and y0 < y1 and x[x1-1] == y[y1-1]:
+      x1 -= 1
+      y1 -= 1
+      matches.append((x1, y1))
+    if x0 == x1 or y0 == y1:
+      continue
+    split = _middle(x, y, x0, x1, y0, y1, maxcost)
+    if split and split != (x0, y0) and split != (x1, y1):
+      i, j = split
+      ranges.append((x0, i, y0, j))
+      ranges.append((i, x1, j, y1))
+  matches.sort()
+  return [(ai[i], bj[j]) for i, j in matches]
+
+
+def _middle(x, y, x0, x1, y0, y1, maxcost):
+  """ return point (i, j) where the shortest edit path between x[x0:x1]
+      and y[y0:y1] is split in two halves, searching from both ends at
+      once. After `maxcost` rounds the furthest point reached by either
+      search is returned. None means the ranges have nothing in common.
+  """
+  n, m = x1 - x0, y1 - y0
+  maxd = (n + m + 1) // 2
+  offset = maxd + 1
+  # furthest x on every diagonal k = x - y, from start and from end
+  vf = [-1] * (2 * offset + 1)
+  vb = [-1] * (2 * offset + 1)
+  vf[offset+1] = vb[offset+1] = 0
+  delta = n - m
+  odd = delta & 1
+  # diagonals that left the grid are not extended any further
+  fstart = fend = bstart = bend = 0
+  for d in xrange(maxd + 1):
+    for k in xrange(-d + fstart, d + 1 - fend, 2):
+      if k == -d or (k != d and vf[offset+k-1] < vf[offset+k+1]):
+        i = vf[offset+k+1]
+      else:
+        i = vf[offset+k-1] + 1
+      j = i - k
+      while i < n and j < m and x[x0+i] == y[y0+j]:
+        i += 1
+        j += 1
+      vf[offset+k] = i
+      if i > n:
+        fend += 2
+      elif j > m:
+        fstart += 2
+      elif odd:
+        kb = offset + delta - k
+        if 0 <= kb < len(vb) and vb[kb] != -1 and i >= n - vb[kb]:
+          return x0 + i, y0 + j
+
+    for k in xrange(-d + bstart, d + 1 - bend, 2):
+      if k == -d or (k != d and vb[offset+k-1] < vb[offset+k+1]):
+        i = vb[offset+k+1]
+      else:
+        i = vb[offset+k-1] + 1
+      j = i - k
+      while i < n and j < m and x[x1-1-i] == y[y1-1-j]:
+        i += 1
+        j += 1
+      vb[offset+k] = i
+      if i > n:
+        bend += 2
+      elif j > m:
+        bstart += 2
+      elif not odd:
+        kf = offset + delta - k
+        if 0 <= kf < len(vf) and vf[kf] != -1 and vf[kf] >= n - i:
+          i = vf[kf]
+          return x0 + i, y0 + i - (delta - k)
+
+    if d >= maxcost:
+      # too expensive - take the point closest to the other end
+      best, point = -1, None
+      for k in xrange(-d + fstart, d + 1 - fend, 2):
+        i = vf[offset+k]
+        if i <= n and 0 <= i - k <= m and i + i - k > best:
+          best, point = i + i - k, (x0 + i, y0 + i - k)
+      for k in xrange(-d + bstart, d + 1 - bend, 2):
+        i = vb[offset+k]
+        if i <= n and 0 <= i - k <= m and i + i - k > best:
+          best, point = i + i - k, (x1 - i, y1 - (i - k))
+      return point
+  return None
+
+
+def _diff_file(args):
+  """ compare old and new contents of a file (see `frombuffers()`),
+      None stands for missing file
+      return tuple (name, Patch or None if nothing changed, binary flag)
+  """
+  name, old, new, context = args
+  if old == new:
+    return name, None, False
+  if '\0' in (old or '') or '\0' in (new or ''):
+    return name, None, True
+  p = Patch()
+  p.type = PLAIN
+  p.source = name if old is not None else DEVNULL
+  p.target = name if new is not None else DEVNULL
+  p.hunks = diffhunks(StringIO(old or '').readlines(), StringIO(new or '').readlines(),
+                      context)
+  p.hunkends = dict(lf=0, crlf=0, cr=0)
+  for h in p.hunks:
+    p.hunkends["lf"] += h.ends.count(1)
+    p.hunkends["crlf"] += h.ends.count(2)
+    p.hunkends["cr"] += h.ends.count(3)
+  p.recount()
+  return name, p, False
+
+def _diff_paths(args):
+  """ compare files at old and new path (see `fromtrees()`) """
+  name, oldpath, newpath, context = args
+  contents = []
+  for path in (oldpath, newpath):
+    data = None
+    if path is not None:
+      fp = open(path, "rb")
+      try:
+        data = fp.read()
+      finally:
+        fp.close()
+    contents.append(data)
+  return _diff_file((name, contents[0], contents[1], context))
+
+def _diffset(results):
+  """ return PatchSet with patches of `_diff_file()` results """
+  ps = PatchSet()
+  ps.type = PLAIN
+  for name, p, binary in results:
+    if binary:
+      warning("skipping binary file %s", name)
+      ps.warnings += 1
+    elif p is not None:
+      ps.items.append(p)
+  return ps
+
+
 # --- Utility functions ---
+re_placeholder = re.compile(r"\{(\w+)\}")
+
+def substitute(text, params):
+  """ replace {name} placeholders in text with values from `params` dict """
+  if not params or '{' not in text:
+    return text
+  def value(match):
+    if match.group(1) in params:
+      return str(params[match.group(1)])
+    return match.group(0)
+  return re_placeholder.sub(value, text)
+
 # [ ] reuse more universal pathsplit()
 def pathstrip(path, n):
   """ Strip n leading components from the given path """
@@ -155,11 +766,106 @@ def pathstrip(path, n):
   while os.path.dirname(pathlist[0]) != '':
     pathlist[0:1] = os.path.split(pathlist[0])
   return '/'.join(pathlist[n:])
+
+def rootpath(root, filename):
+  """ Return path of `filename` in `root` directory. Relative
+      names are kept relative to working dir if root is None.
+  """
+  if root:
+    return os.path.join(root, filename)
+  return filename
+
+def filedigest(filename):
+  """ Return hex digest of file contents """
+  sha = hashlib.sha1()
+  fp = open(filename, "rb")
+  try:
+    for block in iter(lambda: fp.read(65536), ''):
+      sha.update(block)
+  finally:
+    fp.close()
+  return sha.hexdigest()
+
+def writeall(fd, data):
+  """ Write all of `data` to file descriptor `fd` """
+  written = 0
+  while written < len(data):
+    written += os.write(fd, buffer(data, written))
+
+def copyrange(srcfd, tgtfd, offset, count):
+  """ Copy `count` bytes at `offset` of file descriptor `srcfd` to
+      current position of `tgtfd`. The kernel copies the data with
+      os.copy_file_range() or os.sendfile() where available, buffered
+      reads and writes are used otherwise.
+  """
+  for name in ('copy_file_range', 'sendfile'):
+    kernelcopy = getattr(os, name, None)
+    if kernelcopy is None or count <= 0:
+      continue
+    try:
+      while count > 0:
+        if name == 'copy_file_range':
+          copied = kernelcopy(srcfd, tgtfd, count, offset)
+        else:
+          copied = kernelcopy(tgtfd, srcfd, offset, count)
+        if not copied:  # end of file
+          return
+        offset += copied
+        count -= copied
+      return
+    except OSError, e:
+      # unsupported by file system or kernel - try next method
+      debug("%s failed, falling back - %s", name, e)
+
+  os.lseek(srcfd, offset, os.SEEK_SET)
+  while count > 0:
+    block = os.read(srcfd, min(count, 65536))
+    if not block:
+      break
+    writeall(tgtfd, block)
+    count -= len(block)
+
+def splitend(line):
+  """ Split line into payload and index of its line end in
+      LINEENDS tuple
+  """
+  if line.endswith("\r\n"):
+    return line[:-2], 2
+  elif line.endswith("\n"):
+    return line[:-1], 1
+  elif line.endswith("\r"):
+    return line[:-1], 3
+  return line, 0
+
+def lineend(fp):
+  """ Scan file object `fp` from current position to the end in blocks
+      and return the line end all its lines have, or None if line ends
+      are mixed or missing. Like readline(), only line feeds split lines,
+      so a lone CR counts as line end only at the end of file.
+  """
+  crlf = lf = 0
+  last = ''
+  for block in iter(lambda: fp.read(65536), ''):
+    crlf += block.count('\r\n') + (last == '\r' and block[0] == '\n')
+    lf += block.count('\n')
+    last = block[-1]
+  found = [end for end, count in (('\n', lf - crlf), ('\r\n', crlf), ('\r', last == '\r'))
+           if count]
+  if len(found) == 1:
+    return found[0]
+  return None
 # --- /Utility function ---
 
 
 class Hunk(object):
-  """ Parsed hunk data container (hunk starts with @@ -R +R @@) """
+  """ Parsed hunk data container (hunk starts with @@ -R +R @@)
+
+      Every hunk line is stored once - `ops` holds its prefix character
+      (' ', '-', '+' or '\\'), `lines` the payload without prefix and
+      line end, and `ends` the index of the line end in LINEENDS.
+  """
+  __slots__ = ('startsrc', 'linessrc', 'starttgt', 'linestgt',
+               'invalid', 'desc', 'ops', 'lines', 'ends')
 
   def __init__(self):
     self.startsrc=None #: line count starts with 1
@@ -168,23 +874,242 @@ class Hunk(object):
     self.linestgt=None
     self.invalid=False
     self.desc=''
-    self.text=[]
+    self.ops=array('c')
+    self.lines=[]
+    self.ends=array('B')
+
+  def __getstate__(self):
+    # lines are pickled as single string, which is way faster
+    lines = "\n".join(self.lines)
+    if lines.count("\n") != len(self.lines) - 1:
+      lines = self.lines  # some line contains line feed
+    return (self.startsrc, self.linessrc, self.starttgt, self.linestgt,
+            self.invalid, self.desc, self.ops.tostring(), lines,
+            self.ends.tostring())
+
+  def __setstate__(self, state):
+    (self.startsrc, self.linessrc, self.starttgt, self.linestgt,
+     self.invalid, self.desc, ops, lines, ends) = state
+    self.ops = array('c', ops)
+    if isinstance(lines, str):
+      lines = lines.split("\n") if ops else []
+    self.lines = lines
+    self.ends = array('B', ends)
+
+  def append(self, line):
+    """ add line of hunk text, including its prefix and line end """
+    payload, end = splitend(line)
+    self.ops.append(payload[0])
+    self.lines.append(payload[1:])
+    self.ends.append(end)
+
+  def _get_text(self):
+    return [op + line + LINEENDS[end]
+            for op, line, end in izip(self.ops, self.lines, self.ends)]
+
+  def _set_text(self, text):
+    self.ops = array('c')
+    self.lines = []
+    self.ends = array('B')
+    for line in text:
+      self.append(line)
+
+  #: hunk lines as they appear in patch, built on demand
+  text = property(_get_text, _set_text)
+
+  @property
+  def srclines(self):
+    """ view of source lines (context and removed ones) """
+    return HunkLines(self, " -")
+
+  @property
+  def tgtlines(self):
+    """ view of target lines (context and added ones) """
+    return HunkLines(self, " +")
+
+  def reversed(self):
+    """ return view of the hunk with source and target swapped """
+    return ReversedHunk(self)
+
+
+class ReversedHunk(object):
+  """ Hunk seen in reverse direction - view that swaps source and target
+      of the underlying hunk on access. Lines are shared, only prefix
+      characters are translated once on first use.
+  """
+  __slots__ = ('hunk', '_ops')
+
+  def __init__(self, hunk):
+    self.hunk = hunk
+    self._ops = None
+
+  def __getattr__(self, name):
+    # invalid, desc, lines and ends are the same in both directions
+    # special names looked up by copy and pickle are not forwarded, nor
+    # the hunk itself before it is set - that would recurse
+    if name == 'hunk' or name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self.hunk, name)
+
+  startsrc = property(lambda self: self.hunk.starttgt)
+  linessrc = property(lambda self: self.hunk.linestgt)
+  starttgt = property(lambda self: self.hunk.startsrc)
+  linestgt = property(lambda self: self.hunk.linessrc)
+
+  @property
+  def ops(self):
+    if self._ops is None:
+      self._ops = array('c', self.hunk.ops.tostring().translate(REVERSEDOPS))
+    return self._ops
+
+  @property
+  def text(self):
+    return [op + line + LINEENDS[end]
+            for op, line, end in izip(self.ops, self.hunk.lines, self.hunk.ends)]
+
+  @property
+  def srclines(self):
+    return HunkLines(self.hunk, " +")
+
+  @property
+  def tgtlines(self):
+    return HunkLines(self.hunk, " -")
+
+  def reversed(self):
+    return self.hunk
+
+
+class MappedHunk(Hunk):
+  """ Hunk parsed from memory mapped patch file. Hunk lines are a
+      contiguous span of the map, so only its offset and length are
+      kept - `ops`, `lines` and `ends` are split out of the map on
+      every access.
+  """
+  __slots__ = ('source', 'offset', 'length')
 
-#  def apply(self, estream):
-#    """ write hunk data into enumerable stream
-#        return strings one by one until hunk is
-#        over
-#
-#        enumerable stream are tuples (lineno, line)
-#        where lineno starts with 0
-#    """
-#    pass
+  def __init__(self, source):
+    # Hunk.__init__() is not called - there is nothing to store lines in
+    self.startsrc=None
+    self.linessrc=None
+    self.starttgt=None
+    self.linestgt=None
+    self.invalid=False
+    self.desc=''
+    self.source = source  #: MappedLines being parsed
+    self.offset = source.map.tell()
+    self.length = 0
+
+  def __reduce__(self):
+    # the map doesn't travel, copies are plain hunks
+    return (Hunk, (), self.__getstate__())
+
+  def append(self, line):
+    """ extend span to the end of current line of the map """
+    self.length = self.source.map.tell() - self.offset
+
+  def _split(self):
+    # hunk is usually accessed several times in a row, the last split
+    # is kept to avoid repeating it (only one to keep memory constant)
+    cached = self.source.cache
+    if cached and cached[0] == self.offset and cached[1] == self.length:
+      return cached[2]
+    data = self.source.map[self.offset:self.offset+self.length]
+    lines = [line + "\n" for line in data.split("\n")]
+    # the last line is empty if span ends with line feed
+    lines[-1] = lines[-1][:-1]
+    h = Hunk()
+    for line in lines:
+      if not line:
+        break
+      if line.strip("\r\n") == "":
+        line = ' ' + line  # empty line expanded by parser
+      h.append(line)
+    self.source.cache = (self.offset, self.length, h)
+    return h
+
+  ops = property(lambda self: self._split().ops)
+  lines = property(lambda self: self._split().lines)
+  ends = property(lambda self: self._split().ends)
+  text = property(lambda self: self._split().text)
+
+
+class PreparedHunk(Hunk):
+  """ Copy of a hunk (or of a view of it) with its source and target
+      lines split out once into lists, for hunks matched against many
+      files (see `PatchSet.apply_many()`). Must not be changed.
+  """
+  __slots__ = ('srclines', 'tgtlines')
+
+  def __init__(self, hunk):
+    self.startsrc = hunk.startsrc
+    self.linessrc = hunk.linessrc
+    self.starttgt = hunk.starttgt
+    self.linestgt = hunk.linestgt
+    self.invalid = hunk.invalid
+    self.desc = hunk.desc
+    self.ops = hunk.ops
+    self.lines = hunk.lines
+    self.ends = hunk.ends
+    self.srclines = list(hunk.srclines)
+    self.tgtlines = list(hunk.tgtlines)
+
+  def __reduce__(self):
+    # lists are cheap to build again, copies are plain hunks
+    return (Hunk, (), self.__getstate__())
+
+
+class HunkLines(object):
+  """ Read-only view of the source or target lines of a Hunk.
+      Yields payload of lines without copying them.
+  """
+  __slots__ = ('hunk', 'side')
+
+  def __init__(self, hunk, side):
+    self.hunk = hunk
+    self.side = side  #: prefix characters of lines in this view
+
+  def __len__(self):
+    ops = self.hunk.ops
+    return sum(ops.count(op) for op in self.side)
+
+  def __iter__(self):
+    side = self.side
+    for op, line in izip(self.hunk.ops, self.hunk.lines):
+      if op in side:
+        yield line
+
+
+class MappedLines(object):
+  """ Iterable over lines of a read-only memory map of file object `fp`
+  """
+  def __init__(self, fp):
+    self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    # (offset, length, Hunk) of the last span split by MappedHunk
+    self.cache = None
+
+  def __iter__(self):
+    mm = self.map
+    mm.seek(0)
+    while True:
+      line = mm.readline()
+      if not line:
+        return
+      yield line
+
+  def close(self):
+    """ unmap the file, hunks of the map can't be read afterwards """
+    self.cache = None
+    self.map.close()
 
 
 class Patch(object):
   """ Patch for a single file.
       If used as an iterable, returns hunks.
   """
+  __slots__ = ('source', 'target', 'hunks', 'hunkends', 'header', 'type',
+               'insertions', 'deletions', 'delta',
+               'rename', 'oldmode', 'newmode', 'similarity')
+
   def __init__(self):
     self.source = None 
     self.target = None
@@ -194,15 +1119,715 @@ class Patch(object):
 
     self.type = None
 
+    # diffstat counters, maintained by parser
+    self.insertions = 0
+    self.deletions = 0
+    self.delta = 0     # size change in bytes
+
+    # git extended header info - created and deleted files have
+    # DEVNULL as source or target
+    self.rename = False     # source is renamed to target
+    self.oldmode = None     # file mode before and after, if changed
+    self.newmode = None
+    self.similarity = None  # similarity index of renamed file, percent
+
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in self.__slots__)
+
+  def __setstate__(self, state):
+    for name, value in izip(self.__slots__, state):
+      setattr(self, name, value)
+
+  def __iter__(self):
+    for h in self.hunks:
+      yield h
+
+  def recount(self):
+    """ recalculate diffstat counters from hunks """
+    self.insertions = self.deletions = self.delta = 0
+    for hunk in self.hunks:
+      for op, line, end in izip(hunk.ops, hunk.lines, hunk.ends):
+        if op == '+':
+          self.insertions += 1
+          self.delta += len(line) + len(LINEENDS[end])
+        elif op == '-':
+          self.deletions += 1
+          self.delta -= len(line) + len(LINEENDS[end])
+
+  def reversed(self):
+    """ return view of the patch with direction of its hunks reversed """
+    return ReversedPatch(self)
+
+  def isgit(self):
+    """ return True if the patch creates, deletes or renames its file,
+        or changes its mode - which is done by `_apply_git()`
+    """
+    return (self.rename or self.newmode is not None
+            or self.source == DEVNULL or self.target == DEVNULL)
+
+
+class ReversedPatch(object):
+  """ Patch seen in reverse direction. Filenames are left as they are,
+      unless the patch creates, deletes or renames its file. Hunks are
+      ReversedHunk views of the underlying ones.
+  """
+  __slots__ = ('patch', '_hunks')
+
+  def __init__(self, patch):
+    self.patch = patch
+    self._hunks = None
+
+  def __getattr__(self, name):
+    # see ReversedHunk.__getattr__()
+    if name == 'patch' or name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self.patch, name)
+
+  @property
+  def hunks(self):
+    if self._hunks is None:
+      self._hunks = [h.reversed() for h in self.patch.hunks]
+    return self._hunks
+
   def __iter__(self):
     for h in self.hunks:
       yield h
 
+  insertions = property(lambda self: self.patch.deletions)
+  deletions = property(lambda self: self.patch.insertions)
+  delta = property(lambda self: -self.patch.delta)
+  oldmode = property(lambda self: self.patch.newmode)
+  newmode = property(lambda self: self.patch.oldmode)
+
+  @property
+  def source(self):
+    p = self.patch
+    if p.rename or p.target == DEVNULL or p.source == DEVNULL:
+      return p.target
+    return p.source
+
+  @property
+  def target(self):
+    p = self.patch
+    if p.rename or p.target == DEVNULL or p.source == DEVNULL:
+      return p.source
+    return p.target
+
+  def reversed(self):
+    return self.patch
+
+
+class PatchCache(object):
+  """ Persistent cache of patch outcomes. Maps digest of file contents
+      and digest of a Patch to APPLIED or CONFLICT, so files that didn't
+      change since the last run are neither read nor validated again.
+      File digests are remembered along with size and modification time
+      of the file, making a lookup cost a single stat() call.
+
+      Changes are written to `filename` when calling `save()`.
+  """
+  version = 1
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.outcomes = {}  # "patchkey:filedigest" -> outcome
+    self.files = {}     # absolute path -> [size, mtime, filedigest]
+    self.dirty = False
+    self.hits = 0
+    if exists(filename):
+      self.load()
+
+  def load(self):
+    fp = open(self.filename, "rb")
+    try:
+      data = json.load(fp)
+    finally:
+      fp.close()
+    if data.get('version') != self.version:
+      warning("ignoring patch cache of different version - %s", self.filename)
+      return
+    self.outcomes = data['outcomes']
+    self.files = data['files']
+
+  def save(self):
+    """ write cache to its file if it changed """
+    if not self.dirty:
+      return
+    dirname, basename = os.path.split(abspath(self.filename))
+    fd, tmpname = tempfile.mkstemp(prefix="." + basename + ".", dir=dirname)
+    fp = os.fdopen(fd, "wb")
+    try:
+      json.dump(dict(version=self.version, outcomes=self.outcomes, files=self.files), fp)
+    finally:
+      fp.close()
+    if os.name == 'nt' and exists(self.filename):
+      os.unlink(self.filename)
+    os.rename(tmpname, self.filename)
+    self.dirty = False
+
+  def patchkey(self, p, fuzz=None):
+    """ return digest of Patch, covering filenames, hunks and fuzz """
+    sha = hashlib.sha1()
+    sha.update("%s\0%s\0%r\0" % (p.source, p.target, fuzz))
+    for h in p.hunks:
+      sha.update("@@ -%s,%s +%s,%s @@\0" % (h.startsrc, h.linessrc, h.starttgt, h.linestgt))
+      sha.update(h.ops.tostring())
+      sha.update("\0".join(h.lines))
+      sha.update(h.ends.tostring())
+    return sha.hexdigest()
+
+  def digest(self, filepath):
+    """ return digest of file contents, which is only computed if
+        size or modification time changed since the last call
+    """
+    filepath = abspath(filepath)
+    st = os.stat(filepath)
+    known = self.files.get(filepath)
+    if known and known[0] == st.st_size and known[1] == st.st_mtime:
+      return known[2]
+    digest = filedigest(filepath)
+    self.files[filepath] = [st.st_size, st.st_mtime, digest]
+    self.dirty = True
+    return digest
+
+  def get(self, key, digest):
+    """ return outcome recorded for patch `key` and file `digest` or None """
+    outcome = self.outcomes.get(key + ":" + digest)
+    if outcome is not None:
+      self.hits += 1
+    return outcome
+
+  def set(self, key, digest, outcome):
+    self.outcomes[key + ":" + digest] = outcome
+    self.dirty = True
+
+
+class PatchStats(object):
+  """ Timings and counters collected by PatchSet while parsing and
+      applying, to find out which files make patching slow.
+
+      `files` maps name of every processed file to dict with `validate`
+      and `write` times in seconds and `fuzz` - list of (hunk no., offset,
+      fuzz) tuples for hunks placed at an offset or with fuzz.
+      Updates are thread-safe.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def __getstate__(self):
+    return (self.parsetime, self.lines, self.bytes, self.cachehits, self.files)
+
+  def __setstate__(self, state):
+    self.lock = threading.Lock()
+    self.parsetime, self.lines, self.bytes, self.cachehits, self.files = state
+
+  def reset(self):
+    self.parsetime = 0.0  # seconds spent in parser
+    self.lines = 0        # lines of patch streams scanned
+    self.bytes = 0        # bytes of patch streams scanned
+    self.cachehits = 0    # files with outcome taken from PatchCache
+    self.files = {}
+
+  def parsed(self, seconds, lines, bytes):
+    self.lock.acquire()
+    try:
+      self.parsetime += seconds
+      self.lines += lines
+      self.bytes += bytes
+    finally:
+      self.lock.release()
+
+  def timed(self, filename, phase, seconds):
+    """ add `seconds` to time of `phase` ('validate' or 'write') of file """
+    self.lock.acquire()
+    try:
+      self._file(filename)[phase] += seconds
+    finally:
+      self.lock.release()
+
+  def fuzzed(self, filename, moves):
+    """ record list of (hunk no., offset, fuzz) tuples for file """
+    self.lock.acquire()
+    try:
+      self._file(filename)['fuzz'].extend(moves)
+    finally:
+      self.lock.release()
+
+  def cachehit(self):
+    self.lock.acquire()
+    try:
+      self.cachehits += 1
+    finally:
+      self.lock.release()
+
+  def _file(self, filename):
+    entry = self.files.get(filename)
+    if entry is None:
+      entry = self.files[filename] = dict(validate=0.0, write=0.0, fuzz=[])
+    return entry
+
+  def slowest(self, count=10):
+    """ return list of up to `count` (seconds, filename) tuples for files
+        that took the most time to validate and write, slowest first
+    """
+    self.lock.acquire()
+    try:
+      times = [(e['validate'] + e['write'], name) for name, e in self.files.items()]
+    finally:
+      self.lock.release()
+    times.sort(reverse=True)
+    return times[:count]
+
+
+class PatchCancelled(Exception):
+  """ Raised by `PatchTask.result()` if the task was cancelled """
+
+
+class PatchTask(object):
+  """ Handle of parsing or patching done by a background thread, see
+      `PatchSet.apply_async()` and `PatchSet.parse_async()`. Files are
+      processed in chunks, and work stops before the next chunk once
+      the task is cancelled. `callback` is called with the task by the
+      background thread when it is finished, e.g. to wake up an event
+      loop waiting for it.
+  """
+  def __init__(self, work, callback=None):
+    self.processed = 0  #: files processed so far
+    self._work = work
+    self._callback = callback
+    self._cancel = threading.Event()
+    self._done = threading.Event()
+    self._cancelled = False
+    self._result = None
+    self._error = None  # exc_info of exception raised by work
+    self._thread = threading.Thread(target=self._run, name="PatchTask")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    try:
+      try:
+        self._result = self._work(self)
+      except PatchCancelled:
+        info("cancelled after %d file(s)", self.processed)
+        self._cancelled = True
+      except Exception:
+        self._error = sys.exc_info()
+    finally:
+      self._done.set()
+    if self._callback:
+      # nobody is there to catch it in this thread
+      try:
+        self._callback(self)
+      except Exception:
+        warning("callback of %s failed", self._thread.name, exc_info=True)
+
+  def chunks(self, items, chunksize):
+    """ yield from `items`, counting them as processed once the
+        consumer asks for the next one. PatchCancelled is raised
+        before every chunk of `chunksize` items if cancel was requested.
+    """
+    for i, item in enumerate(items):
+      if i % chunksize == 0 and self._cancel.is_set():
+        raise PatchCancelled()
+      yield item
+      self.processed = i + 1
+
+  def cancel(self):
+    """ ask to stop before the next chunk of files
+        return False if the task is finished already
+    """
+    if self._done.is_set():
+      return False
+    self._cancel.set()
+    return True
+
+  def cancelled(self):
+    """ return True if the task stopped because it was cancelled """
+    return self._cancelled
+
+  def done(self):
+    return self._done.is_set()
+
+  def wait(self, timeout=None):
+    """ wait until the task is finished or `timeout` seconds passed
+        return True if the task is finished
+    """
+    self._done.wait(timeout)
+    return self._done.is_set()
+
+  def result(self):
+    """ wait for the task and return its result, re-raise exception that
+        stopped it, or raise PatchCancelled if it was cancelled
+    """
+    self._done.wait()
+    if self._cancelled:
+      raise PatchCancelled("task was cancelled after %d file(s)" % self.processed)
+    if self._error:
+      raise self._error[0], self._error[1], self._error[2]
+    return self._result
+
+
+class _Parser(object):
+  """ Unified diff parser for PatchSet.iterparse() - a state machine
+      driven by a table of handlers, one per state. A handler gets the
+      next line of the stream and returns the next state. If the line
+      must be processed by the next state too, the handler passes it
+      on by calling handler of that state itself.
+
+      Lines are told apart by their first bytes, regular expression is
+      only used for hunk headers. Finished patches are collected in
+      `done` until they are handed out.
+  """
+
+  # states (possible file regions) that direct parse flow
+  HEADSCAN   = 0  # scanning header, nothing read yet
+  HEADER     = 1  # scanning header, some lines read
+  FILENAMES  = 2  # lines starting with --- and +++
+  HUNKHEAD   = 3  # @@ -R +R @@ sequence
+  HUNKBODY   = 4
+  HUNKSKIP   = 5  # skipping invalid hunk mode
+  HUNKPARSED = 6  # state after successfully parsed hunk
+
+  # regexp to match start of hunk, used groups - 1,3,4,6,7
+  re_hunk = re.compile(r"^@@ -(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@(.*)")
+
+  #: prefixes of hunk body lines, the number of source and target
+  #: lines they stand for and sign of their size in diffstat delta
+  bodylines = {' ': (1, 1, 0), '-': (1, 0, -1), '+': (0, 1, 1), '\\': (0, 0, 0)}
+
+  #: git extended header lines that make a patch without --- and +++ lines
+  gitlines = ("old mode ", "new mode ", "new file mode ", "deleted file mode ",
+              "rename from ", "rename to ")
+  #: git extended header lines of binary content, which can't be applied
+  binarylines = ("Binary files ", "GIT binary patch")
+  re_gitdiff = re.compile(r"diff --git (a/.+) (b/.+)")
+
+  def __init__(self, patchset, mapped=None):
+    self.patchset = patchset
+    self.mapped = mapped  # MappedLines being parsed, if any
+    self.done = []        # finished patches that are not handed out yet
+    self.parsed = 0       # number of finished patches
+    self.p = None
+    self.hunk = None
+    self.hunkno = 0       #: user messages number hunks from 1
+    self.srcleft = 0      # source lines expected in hunk body
+    self.tgtleft = 0      # target lines expected in hunk body
+    self.hunkdelta = 0    # size change in bytes made by hunk
+    # temp buffers for header and filenames info
+    self.header = []
+    self.srcname = None
+    # handlers indexed by state
+    self.table = (self.headscan, self.headscan, self.filenames,
+                  self.hunkhead, self.hunkbody, self.hunkskip,
+                  self.hunkparsed)
+
+  def finishpatch(self):
+    self.parsed += 1
+    self.done.append(self.patchset._finish_patch(self.p, self.parsed))
+    self.p = None
+
+  def headscan(self, line, lineno):
+    if line.startswith("--- "):
+      return self.filenames(line, lineno)
+    if line.startswith("diff --git ") and self.header:
+      self.gitpatch()
+    if line.startswith(self.binarylines) and self.githeader() is not None:
+      # renames or mode changes of the file are dropped too, as they
+      # are not complete without the content
+      warning("skipping binary patch: %s", self.header[self.githeader()].rstrip())
+      self.patchset.errors += 1
+      self.header = []
+      return self.HEADSCAN
+    self.header.append(line)
+    return self.HEADER
+
+  def githeader(self):
+    """ return index of the `diff --git` line of header read so far
+        or None if it is not a git diff
+    """
+    header = self.header
+    for idx in range(len(header)-1, -1, -1):
+      if header[idx].startswith("diff --git "):
+        return idx
+    return None
+
+  def gitpatch(self):
+    """ hand out header read so far as a patch without hunks, if it is
+        a git diff that renames a file, changes its mode or creates or
+        deletes an empty file. Names are taken from `diff --git` line,
+        extended header is read by `PatchSet._git_header()`.
+        return True if patch was handed out
+    """
+    header = self.header
+    idx = self.githeader()
+    if idx is None:
+      return False
+    if not any(line.startswith(self.gitlines) for line in header[idx+1:]):
+      return False
+    match = self.re_gitdiff.match(header[idx].rstrip("\r\n"))
+    if not match:
+      return False
+    if self.p:
+      self.finishpatch()
+    p = self.p = Patch()
+    p.source, p.target = match.groups()
+    p.header = header
+    p.hunkends = dict(lf=0, crlf=0, cr=0)
+    self.header = []
+    self.finishpatch()
+    return True
+
+  def filenames(self, line, lineno):
+    ps = self.patchset
+    if line.startswith("--- "):
+      if self.srcname != None:
+        # XXX testcase
+        warning("skipping false patch for %s", self.srcname)
+        self.srcname = None
+        # double source filename line is encountered
+        # attempt to restart from this second line
+      # todo: support spaces in filenames
+      name = line[4:].split("\t", 1)[0]
+      if not name:
+        warning("skipping invalid filename at line %d", lineno)
+        ps.errors += 1
+        return self.HEADSCAN
+      self.srcname = name.strip()
+      return self.FILENAMES
+
+    if not line.startswith("+++ "):
+      if self.srcname != None:
+        warning("skipping invalid patch with no target for %s", self.srcname)
+        ps.errors += 1
+        self.srcname = None
+      else:
+        # this should be unreachable
+        warning("skipping invalid target patch")
+      return self.HEADSCAN
+
+    name = line[4:].split("\t", 1)[0]
+    if not name:
+      warning("skipping invalid patch - no target filename at line %d", lineno)
+      ps.errors += 1
+      self.srcname = None
+      return self.HEADSCAN
+
+    if self.p: # for the first run p is None
+      self.finishpatch()
+    p = self.p = Patch()
+    p.source = self.srcname
+    self.srcname = None
+    p.target = name.strip()
+    p.header = self.header
+    self.header = []
+    p.hunkends = dict(lf=0, crlf=0, cr=0)
+    self.hunkno = 0
+    return self.HUNKHEAD
+
+  def hunkhead(self, line, lineno):
+    match = self.re_hunk.match(line)
+    if not match:
+      if not self.p.hunks:
+        warning("skipping invalid patch with no hunks for file %s", self.p.source)
+        self.patchset.errors += 1
+      return self.HEADSCAN
+
+    if self.mapped:
+      hunk = self.hunk = MappedHunk(self.mapped)
+    else:
+      hunk = self.hunk = Hunk()
+    hunk.startsrc = int(match.group(1))
+    hunk.linessrc = 1
+    if match.group(3): hunk.linessrc = int(match.group(3))
+    hunk.starttgt = int(match.group(4))
+    hunk.linestgt = 1
+    if match.group(6): hunk.linestgt = int(match.group(6))
+    hunk.desc = match.group(7)[1:].rstrip()
+
+    self.srcleft = hunk.linessrc
+    self.tgtleft = hunk.linestgt
+    self.hunkdelta = 0
+    self.hunkno += 1
+    return self.HUNKBODY
+
+  def hunkbody(self, line, lineno):
+    counts = self.bodylines.get(line[:1])
+    if counts is None:
+      # [x] treat empty lines inside hunks as containing single space
+      #     (this happens when diff is saved by copy/pasting to editor
+      #      that strips trailing whitespace)
+      if line.strip("\r\n") == "":
+        debug("expanding empty line in a middle of hunk body")
+        self.patchset.warnings += 1
+        line = ' ' + line
+        counts = (1, 1, 0)
+      else:
+        warning("invalid hunk no.%d at %d for target file %s", self.hunkno, lineno+1, self.p.target)
+        self.hunk.invalid = True
+        self.addhunk()
+        self.patchset.errors += 1
+        return self.hunkskip(line, lineno)
+
+    self.hunk.append(line)
+    # todo: handle \ No newline cases
+    self.srcleft -= counts[0]
+    self.tgtleft -= counts[1]
+    if counts[2]:
+      self.hunkdelta += counts[2] * (len(line) - 1)
+
+    # check exit conditions
+    if self.srcleft < 0 or self.tgtleft < 0:
+      warning("extra lines for hunk no.%d at %d for target %s", self.hunkno, lineno+1, self.p.target)
+      self.hunk.invalid = True
+      self.addhunk()
+      self.patchset.errors += 1
+      return self.hunkskip(line, lineno)
+    if self.srcleft or self.tgtleft:
+      return self.HUNKBODY
+
+    # hunk parsed successfully
+    self.addhunk()
+    # detect mixed window/unix line ends
+    ends = self.p.hunkends
+    if ((ends["cr"]!=0) + (ends["crlf"]!=0) + (ends["lf"]!=0)) > 1:
+      warning("inconsistent line ends in patch hunks for %s", self.p.source)
+      self.patchset.warnings += 1
+    if debugmode:
+      debuglines = dict(ends)
+      debuglines.update(file=self.p.target, hunk=self.hunkno)
+      debug("crlf: %(crlf)d  lf: %(lf)d  cr: %(cr)d\t - file: %(file)s hunk: %(hunk)d", debuglines)
+    return self.HUNKPARSED
+
+  def addhunk(self):
+    """ add current hunk to its patch, updating diffstat counters """
+    hunk = self.hunk
+    p = self.p
+    p.hunks.append(hunk)
+    ops = hunk.ops
+    p.insertions += ops.count('+')
+    p.deletions += ops.count('-')
+    p.delta += self.hunkdelta
+    self.countends()
+
+  def countends(self):
+    """ gather stats about line endings of current hunk """
+    hunkends = self.hunk.ends
+    ends = self.p.hunkends
+    ends["lf"] += hunkends.count(1)
+    ends["crlf"] += hunkends.count(2)
+    ends["cr"] += hunkends.count(3)
+
+  def hunkskip(self, line, lineno):
+    if line.startswith("@@") and self.re_hunk.match(line):
+      return self.hunkhead(line, lineno)
+    if line.startswith("--- "):
+      if debugmode and self.p:
+        debug("- %2d hunks for %s", len(self.p.hunks), self.p.source)
+      return self.filenames(line, lineno)
+    return self.HUNKSKIP
+
+  def hunkparsed(self, line, lineno):
+    if line.startswith("@@") and self.re_hunk.match(line):
+      return self.hunkhead(line, lineno)
+    if line.startswith("\\"):
+      # \ No newline at end of file - after the last line of hunk
+      self.hunk.append(line)
+      return self.HUNKPARSED
+    # no more hunks for this file - hand it out
+    self.finishpatch()
+    if line.startswith("--- "):
+      return self.filenames(line, lineno)
+    return self.headscan(line, lineno)
+
+  def finish(self, state):
+    """ account for end of stream reached in `state` """
+    ps = self.patchset
+    if state == self.HEADER and self.gitpatch():
+      state = self.HEADSCAN
+    if state == self.HEADER:
+      if self.p == None and self.parsed == 0:
+        debug("no patch data found")  # error is shown later
+        ps.errors += 1
+      else:
+        info("%d unparsed bytes left at the end of stream", len(''.join(self.header)))
+        ps.warnings += 1
+        # TODO check for \No new line at the end..
+        # TODO test for unparsed bytes
+        # otherwise error += 1
+
+    if state == self.HUNKBODY:
+      self.countends()
+    if debugmode and self.p:
+      debug("- %2d hunks for %s", len(self.p.hunks), self.p.source)
+    if self.p:
+      self.finishpatch()
+
+    if state == self.HUNKSKIP:
+      warning("warning: finished with errors, some hunks may be invalid")
+    elif state in (self.HEADSCAN, self.HEADER):
+      if self.parsed == 0:
+        warning("error: no patch data found!")
+      # else: extra data at the end of file
+    elif state != self.HUNKPARSED:
+      warning("error: patch stream is incomplete!")
+      ps.errors += 1
+
+
+class _ChunkParser(_Parser):
+  """ Parser of a slice of patch stream in worker process. Patches
+      are finished by the parent, so their position is marked among
+      held back log records.
+  """
+  def finishpatch(self):
+    self.parsed += 1
+    self.done.append(self.p)
+    holding.local.records.append(len(self.done) - 1)
+    self.p = None
+
+
+def _parse_chunk(args):
+  """ parse slice of patch stream (see PatchSet._parse_parallel())
+      return tuple (patches, errors, warnings, records, state)
+  """
+  lines, lineoffset, first, last = args
+  if isinstance(lines, str):
+    lines = StringIO(lines)
+  ps = PatchSet()
+  parser = _ChunkParser(ps)
+  if not first:
+    parser.parsed = 1  # slices are cut after a parsed patch
+  table = parser.table
+  state = parser.HEADSCAN
+  holding.local.records = records = []
+  try:
+    for lineno, line in enumerate(lines, lineoffset):
+      state = table[state](line, lineno)
+    if last:
+      parser.finish(state)
+    elif state == parser.HUNKPARSED:
+      # next slice starts with a new file
+      parser.finishpatch()
+  finally:
+    holding.local.records = None
+  # plain dicts are sent back instead of log records
+  records = [r if isinstance(r, int) else r.__dict__ for r in records]
+  return parser.done, ps.errors, ps.warnings, records, state
+
+
+class _Moved(str):
+  """ Name of original file staged for a rename in atomic mode - it is
+      moved on commit instead of a staged copy, and kept on rollback
+  """
+
 
 class PatchSet(object):
   """ PatchSet is a patch parser and container.
       When used as an iterable, returns patches.
   """
+  #: version of format written by `compile()`
+  compiled_version = 2
 
   def __init__(self, stream=None):
     # --- API accessible fields ---
@@ -219,6 +1844,14 @@ class PatchSet(object):
     self.warnings = 0  # non-critical warnings
     # --- /API ---
 
+    # timings and counters of parsing and applying
+    self.stats = PatchStats()
+
+    # (items, count, root, index) of the last sourceindex() call
+    self._sourceindex = None
+    # MappedLines of files parsed by parse_mapped(), see close()
+    self._mapped = []
+
     if stream:
       self.parse(stream)
 
@@ -229,349 +1862,237 @@ class PatchSet(object):
     for i in self.items:
       yield i
 
-  def parse(self, stream):
-    """ parse unified diff
+  def parse(self, stream, jobs=None):
+    """ parse unified diff, using a pool of `jobs` processes
+        if it is given (see `_parse_parallel()`)
         return True on success
     """
-    lineends = dict(lf=0, crlf=0, cr=0)
-    nexthunkno = 0    #: even if index starts with 0 user messages number hunks from 1
-
-    p = None
-    hunk = None
-    # hunkactual variable is used to calculate hunk lines for comparison
-    hunkactual = dict(linessrc=None, linestgt=None)
-
-
-    class wrapumerate(enumerate):
-      """Enumerate wrapper that uses boolean end of stream status instead of
-      StopIteration exception, and properties to access line information.
-      """
-
-      def __init__(self, *args, **kwargs):
-        # we don't call parent, it is magically created by __new__ method
-
-        self._exhausted = False
-        self._lineno = False     # after end of stream equal to the num of lines
-        self._line = False       # will be reset to False after end of stream
-
-      def next(self):
-        """Try to read the next line and return True if it is available,
-           False if end of stream is reached."""
-        if self._exhausted:
-          return False
-
-        try:
-          self._lineno, self._line = super(wrapumerate, self).next()
-        except StopIteration:
-          self._exhausted = True
-          self._line = False
-          return False
-        return True
-
-      @property
-      def is_empty(self):
-        return self._exhausted
-
-      @property
-      def line(self):
-        return self._line
-
-      @property
-      def lineno(self):
-        return self._lineno
-
-    # define states (possible file regions) that direct parse flow
-    headscan  = True  # start with scanning header
-    filenames = False # lines starting with --- and +++
+    if jobs and jobs > 1:
+      self._parse_parallel(list(stream), jobs)
+    else:
+      for p in self.iterparse(stream):
+        self.items.append(p)
 
-    hunkhead = False  # @@ -R +R @@ sequence
-    hunkbody = False  #
-    hunkskip = False  # skipping invalid hunk mode
+    # XXX fix total hunks calculation
+    if logger.isEnabledFor(logging.DEBUG):
+      debug("total files: %d  total hunks: %d", len(self.items),
+            sum(len(p.hunks) for p in self.items))
 
-    hunkparsed = False # state after successfully parsed hunk
+    return (self.errors == 0)
 
-    # regexp to match start of hunk, used groups - 1,3,4,6
-    re_hunk_start = re.compile("^@@ -(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@")
-    
+  def parse_async(self, stream, chunksize=16, callback=None):
+    """ parse unified diff like `parse()`, but in a background thread,
+        returning PatchTask at once. Cancelling the task stops parsing
+        before the next chunk of `chunksize` files, patches parsed so
+        far are kept in `items`. `callback` is the same as for PatchTask.
+    """
+    def work(task):
+      for p in task.chunks(self.iterparse(stream), chunksize):
+        self.items.append(p)
+      return (self.errors == 0)
+    return PatchTask(work, callback)
+
+  def parse_mapped(self, fp):
+    """ parse unified diff from file object `fp` through a read-only
+        memory map. Hunks keep offsets and lengths of their lines in
+        the map instead of copies, so resident memory stays small even
+        for huge files. Lines are copied out of the map when compared
+        or written.
+        return True on success
+    """
+    try:
+      lines = MappedLines(fp)
+    except (ValueError, mmap.error), e:
+      # empty files and pipes can't be mapped
+      debug("can't map patch file, reading it - %s", e)
+      return self.parse(fp)
+    self._mapped.append(lines)
+    return self.parse(lines)
+
+  def close(self):
+    """ release memory maps of files parsed by `parse_mapped()`, so
+        they can be removed or replaced (mapped files are locked on
+        Windows). Hunks parsed from them can't be used afterwards.
+    """
+    while self._mapped:
+      self._mapped.pop().close()
+
+  def iterparse(self, stream):
+    """ parse unified diff incrementally - generator that yields
+        every Patch as soon as parsing of its hunks is finished,
+        without adding it to `items`. Errors, warnings and type
+        of the patch set are updated on the way.
+    """
     self.errors = 0
-    # temp buffers for header and filenames info
-    header = []
-    srcname = None
-    tgtname = None
-
-    # start of main cycle
-    # each parsing block already has line available in fe.line
-    fe = wrapumerate(stream)
-    while fe.next():
-
-      # -- deciders: these only switch state to decide who should process
-      # --           line fetched at the start of this cycle
-      if hunkparsed:
-        hunkparsed = False
-        if re_hunk_start.match(fe.line):
-            hunkhead = True
-        elif fe.line.startswith("--- "):
-            filenames = True
-        else:
-            headscan = True
-      # -- ------------------------------------
-
-      # read out header
-      if headscan:
-        while not fe.is_empty and not fe.line.startswith("--- "):
-            header.append(fe.line)
-            fe.next()
-        if fe.is_empty:
-            if p == None:
-              debug("no patch data found")  # error is shown later
-              self.errors += 1
-            else:
-              info("%d unparsed bytes left at the end of stream" % len(''.join(header)))
-              self.warnings += 1
-              # TODO check for \No new line at the end.. 
-              # TODO test for unparsed bytes
-              # otherwise error += 1
-            # this is actually a loop exit
-            continue
-
-        headscan = False
-        # switch to filenames state
-        filenames = True
-
-      line = fe.line
-      lineno = fe.lineno
-
-
-      # hunkskip and hunkbody code skipped until definition of hunkhead is parsed
-      if hunkbody:
-        # [x] treat empty lines inside hunks as containing single space
-        #     (this happens when diff is saved by copy/pasting to editor
-        #      that strips trailing whitespace)
-        if line.strip("\r\n") == "":
-            debug("expanding empty line in a middle of hunk body")
-            self.warnings += 1
-            line = ' ' + line
-
-        # process line first
-        if re.match(r"^[- \+\\]", line):
-            # gather stats about line endings
-            if line.endswith("\r\n"):
-              p.hunkends["crlf"] += 1
-            elif line.endswith("\n"):
-              p.hunkends["lf"] += 1
-            elif line.endswith("\r"):
-              p.hunkends["cr"] += 1
-              
-            if line.startswith("-"):
-              hunkactual["linessrc"] += 1
-            elif line.startswith("+"):
-              hunkactual["linestgt"] += 1
-            elif not line.startswith("\\"):
-              hunkactual["linessrc"] += 1
-              hunkactual["linestgt"] += 1
-            hunk.text.append(line)
-            # todo: handle \ No newline cases
-        else:
-            warning("invalid hunk no.%d at %d for target file %s" % (nexthunkno, lineno+1, p.target))
-            # add hunk status node
-            hunk.invalid = True
-            p.hunks.append(hunk)
-            self.errors += 1
-            # switch to hunkskip state
-            hunkbody = False
-            hunkskip = True
-
-        # check exit conditions
-        if hunkactual["linessrc"] > hunk.linessrc or hunkactual["linestgt"] > hunk.linestgt:
-            warning("extra lines for hunk no.%d at %d for target %s" % (nexthunkno, lineno+1, p.target))
-            # add hunk status node
-            hunk.invalid = True
-            p.hunks.append(hunk)
-            self.errors += 1
-            # switch to hunkskip state
-            hunkbody = False
-            hunkskip = True
-        elif hunk.linessrc == hunkactual["linessrc"] and hunk.linestgt == hunkactual["linestgt"]:
-            # hunk parsed successfully
-            p.hunks.append(hunk)
-            # switch to hunkparsed state
-            hunkbody = False
-            hunkparsed = True
-
-            # detect mixed window/unix line ends
-            ends = p.hunkends
-            if ((ends["cr"]!=0) + (ends["crlf"]!=0) + (ends["lf"]!=0)) > 1:
-              warning("inconsistent line ends in patch hunks for %s" % p.source)
-              self.warnings += 1
-            if debugmode:
-              debuglines = dict(ends)
-              debuglines.update(file=p.target, hunk=nexthunkno)
-              debug("crlf: %(crlf)d  lf: %(lf)d  cr: %(cr)d\t - file: %(file)s hunk: %(hunk)d" % debuglines)
-            # fetch next line
-            continue
-
-      if hunkskip:
-        if re_hunk_start.match(line):
-          # switch to hunkhead state
-          hunkskip = False
-          hunkhead = True
-        elif line.startswith("--- "):
-          # switch to filenames state
-          hunkskip = False
-          filenames = True
-          if debugmode and len(self.items) > 0:
-            debug("- %2d hunks for %s" % (len(p.hunks), p.source))
-
-      if filenames:
-        if line.startswith("--- "):
-          if srcname != None:
-            # XXX testcase
-            warning("skipping false patch for %s" % srcname)
-            srcname = None
-            # XXX header += srcname
-            # double source filename line is encountered
-            # attempt to restart from this second line
-          re_filename = "^--- ([^\t]+)"
-          match = re.match(re_filename, line)
-          # todo: support spaces in filenames
-          if match:
-            srcname = match.group(1).strip()
-          else:
-            warning("skipping invalid filename at line %d" % lineno)
-            self.errors += 1
-            # XXX p.header += line
-            # switch back to headscan state
-            filenames = False
-            headscan = True
-        elif not line.startswith("+++ "):
-          if srcname != None:
-            warning("skipping invalid patch with no target for %s" % srcname)
-            self.errors += 1
-            srcname = None
-            # XXX header += srcname
-            # XXX header += line
-          else:
-            # this should be unreachable
-            warning("skipping invalid target patch")
-          filenames = False
-          headscan = True
-        else:
-          if tgtname != None:
-            # XXX seems to be a dead branch  
-            warning("skipping invalid patch - double target at line %d" % lineno)
-            self.errors += 1
-            srcname = None
-            tgtname = None
-            # XXX header += srcname
-            # XXX header += tgtname
-            # XXX header += line
-            # double target filename line is encountered
-            # switch back to headscan state
-            filenames = False
-            headscan = True
-          else:
-            re_filename = "^\+\+\+ ([^\t]+)"
-            match = re.match(re_filename, line)
-            if not match:
-              warning("skipping invalid patch - no target filename at line %d" % lineno)
-              self.errors += 1
-              srcname = None
-              # switch back to headscan state
-              filenames = False
-              headscan = True
-            else:
-              if p: # for the first run p is None
-                self.items.append(p)
-              p = Patch()
-              p.source = srcname
-              srcname = None
-              p.target = match.group(1).strip()
-              p.header = header
-              header = []
-              # switch to hunkhead state
-              filenames = False
-              hunkhead = True
-              nexthunkno = 0
-              p.hunkends = lineends.copy()
-              continue
-
-      if hunkhead:
-        match = re.match("^@@ -(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@(.*)", line)
-        if not match:
-          if not p.hunks:
-            warning("skipping invalid patch with no hunks for file %s" % p.source)
-            self.errors += 1
-            # XXX review switch
-            # switch to headscan state
-            hunkhead = False
-            headscan = True
-            continue
-          else:
-            # TODO review condition case
-            # switch to headscan state
-            hunkhead = False
-            headscan = True
-        else:
-          hunk = Hunk()
-          hunk.startsrc = int(match.group(1))
-          hunk.linessrc = 1
-          if match.group(3): hunk.linessrc = int(match.group(3))
-          hunk.starttgt = int(match.group(4))
-          hunk.linestgt = 1
-          if match.group(6): hunk.linestgt = int(match.group(6))
-          hunk.invalid = False
-          hunk.desc = match.group(7)[1:].rstrip()
-          hunk.text = []
-
-          hunkactual["linessrc"] = hunkactual["linestgt"] = 0
-
-          # switch to hunkbody state
-          hunkhead = False
-          hunkbody = True
-          nexthunkno += 1
-          continue
-
-    # /while fe.next()
-
-    if p:
-      self.items.append(p)
-
-    if not hunkparsed:
-      if hunkskip:
-        warning("warning: finished with errors, some hunks may be invalid")
-      elif headscan:
-        if len(self.items) == 0:
-          warning("error: no patch data found!")
-          return False
-        else: # extra data at the end of file
-          pass 
+    parser = _Parser(self, stream if isinstance(stream, MappedLines) else None)
+    table = parser.table
+    done = parser.done
+    state = parser.HEADSCAN
+
+    # stats are updated before handing out patches, so time
+    # spent by consumer is not counted
+    stats = self.stats
+    lineno = mark = -1
+    scanned = 0
+    started = time.time()
+    for lineno, line in enumerate(stream):
+      scanned += len(line)
+      state = table[state](line, lineno)
+      if done:
+        stats.parsed(time.time() - started, lineno - mark, scanned)
+        for p in done:
+          yield p
+        del done[:]
+        mark = lineno
+        scanned = 0
+        started = time.time()
+
+    parser.finish(state)
+    stats.parsed(time.time() - started, lineno - mark, scanned)
+    for p in done:
+      yield p
+
+  def compile(self):
+    """ return compact serialized form of the patch set, which is
+        loaded by `fromcompiled()` way faster than the patch is parsed.
+        Placeholders like {name} are kept, so they can be substituted
+        when loading.
+    """
+    patches = []
+    for p in self.items:
+      hunks = [h.__getstate__() for h in p.hunks]
+      patches.append((p.source, p.target, p.type, p.header, p.hunkends,
+                      p.insertions, p.deletions, p.delta,
+                      p.rename, p.oldmode, p.newmode, p.similarity, hunks))
+    return marshal.dumps((self.compiled_version, self.name, self.type,
+                          self.errors, self.warnings, patches))
+
+  def _split(self, lines, count):
+    """ return list of (start, end) slices of `lines`, cut into up to
+        `count` pieces of similar size before lines that look like a
+        start of the next file
+    """
+    bounds = [0]
+    size = len(lines) // count
+    for k in range(1, count):
+      i = max(k * size, bounds[-1] + 1)
+      while i < len(lines):
+        line = lines[i]
+        if line.startswith("diff ") or line.startswith("Index: "):
+          break
+        if line.startswith("--- ") and lines[i-1][:1] in (' ', '+', '-', '\\'):
+          break
+        i += 1
+      if i >= len(lines):
+        break
+      bounds.append(i)
+    bounds.append(len(lines))
+    return zip(bounds, bounds[1:])
+
+  def _joined(self, lines):
+    """ return lines joined into string, which is way faster to pickle
+        than list, if they can be split back on line feeds
+    """
+    data = ''.join(lines)
+    if (data.count('\n') == len(lines) - 1 + lines[-1].endswith('\n')
+        and all(line.endswith('\n') for line in lines[:-1])):
+      return data
+    return lines
+
+  def _parse_parallel(self, lines, jobs):
+    """ parse list of lines in slices by a pool of `jobs` processes
+        and merge the results in order.
+
+        Slices are cut before probable start of a file. The cut is
+        right if parsing of the previous slice ended after a complete
+        hunk - the serial parser would hand out the patch and start
+        from scratch on the same line. Otherwise the two slices are
+        parsed again as one, so the outcome is the same as of the
+        serial parser.
+    """
+    started = time.time()
+    spans = self._split(lines, jobs * 2)
+    if len(spans) < 2:
+      # no place to cut found
+      for p in self.iterparse(lines):
+        self.items.append(p)
+      return
+    last = len(lines)
+    tasks = [(self._joined(lines[a:b]), a, a == 0, b == last) for a, b in spans]
+    pool = Pool(jobs)
+    try:
+      results = pool.map(_parse_chunk, tasks)
+    finally:
+      pool.close()
+      pool.join()
+
+    merged = []
+    for (a, b), result in zip(spans, results):
+      if merged and merged[-1][2][4] != _Parser.HUNKPARSED:
+        start = merged[-1][0]
+        debug("reparsing lines %d-%d in one piece", start+1, b)
+        result = _parse_chunk((lines[start:b], start, start == 0, b == last))
+        merged[-1] = (start, b, result)
       else:
-        warning("error: patch stream is incomplete!")
-        self.errors += 1
-        if len(self.items) == 0:
-          return False
-
-    if debugmode and len(self.items) > 0:
-        debug("- %2d hunks for %s" % (len(p.hunks), p.source))
+        merged.append((a, b, result))
 
-    # XXX fix total hunks calculation
-    debug("total files: %d  total hunks: %d" % (len(self.items),
-        sum(len(p.hunks) for p in self.items)))
-
-    # ---- detect patch and patchset types ----
-    for idx, p in enumerate(self.items):
-      self.items[idx].type = self._detect_type(p)
-
-    types = set([p.type for p in self.items])
-    if len(types) > 1:
+    self.errors = 0
+    for start, end, (patches, errors, warnings, records, state) in merged:
+      for record in records:
+        if isinstance(record, int):
+          p = self._finish_patch(patches[record], len(self.items) + 1)
+          self.items.append(p)
+        else:
+          logger.handle(logging.makeLogRecord(record))
+      self.errors += errors
+      self.warnings += warnings
+    self.stats.parsed(time.time() - started, len(lines), sum(len(l) for l in lines))
+
+  def _finish_patch(self, p, no):
+    """ detect type and normalize filenames of freshly parsed
+        Patch, updating type of the patch set.
+        `no` is the number of the patch counting from 1
+    """
+    p.type = self._detect_type(p)
+    if self.type is None:
+      self.type = p.type
+    elif self.type != p.type:
       self.type = MIXED
+    if p.type in (GIT, HG):
+      self._git_header(p)
+    self._normalize_filenames(p, no)
+    return p
+
+  def _git_header(self, p):
+    """ read git extended header lines of Patch - renames, file modes
+        and similarity index. Source of created and target of deleted
+        files become DEVNULL
+    """
+    for idx in reversed(range(len(p.header))):
+      if p.header[idx].startswith("diff --git "):
+        break
     else:
-      self.type = types.pop()
-    # --------
-
-    self._normalize_filenames()
-    
-    return (self.errors == 0)
+      return
+    for line in p.header[idx+1:]:
+      line = line.rstrip("\r\n")
+      try:
+        if line.startswith("rename from ") or line.startswith("rename to "):
+          p.rename = True
+        elif line.startswith("similarity index "):
+          p.similarity = int(line[17:].rstrip("%"))
+        elif line.startswith("old mode "):
+          p.oldmode = int(line[9:], 8)
+        elif line.startswith("new mode "):
+          p.newmode = int(line[9:], 8)
+        elif line.startswith("new file mode "):
+          p.newmode = int(line[14:], 8)
+          p.source = DEVNULL
+        elif line.startswith("deleted file mode "):
+          p.oldmode = int(line[18:], 8)
+          p.target = DEVNULL
+      except ValueError:
+        warning("invalid git extended header line '%s'", line)
+        self.warnings += 1
 
   def _detect_type(self, p):
     """ detect and return type for the specified Patch object
@@ -596,8 +2117,7 @@ class PatchSet(object):
     # GIT type check
     #  - header[-2] is like "diff --git a/oldname b/newname"
     #  - header[-1] is like "index <hash>..<hash> <mode>"
-    # TODO add git rename diffs and add/remove diffs
-    #      add git diff with spaced filename
+    # TODO add git diff with spaced filename
     # TODO http://www.kernel.org/pub/software/scm/git/docs/git-diff.html
 
     # detect the start of diff header - there might be some comments before
@@ -606,10 +2126,13 @@ class PatchSet(object):
         if p.header[idx].startswith("diff --git"):
           break
       if re.match(r'diff --git a/[\w/.]+ b/[\w/.]+', p.header[idx]):
-        if (idx+1 < len(p.header)
-            and re.match(r'index \w{7}..\w{7} \d{6}', p.header[idx+1])):
-          if DVCS:
-            return GIT
+        # index line follows extended header lines, if there are any
+        for line in p.header[idx+1:]:
+          if re.match(r'index \w{7}..\w{7}( \d{6})?', line) or \
+             line.startswith(_Parser.gitlines + ("similarity index ",)):
+            if DVCS:
+              return GIT
+            break
 
     # HG check
     # 
@@ -634,8 +2157,8 @@ class PatchSet(object):
     return PLAIN
 
 
-  def _normalize_filenames(self):
-    """ sanitize filenames, normalizing paths, i.e.:
+  def _normalize_filenames(self, p, no):
+    """ sanitize filenames of Patch number `no`, normalizing paths, i.e.:
         1. strip a/ and b/ prefixes from GIT and HG style patches
         2. remove all references to parent directories (with warning)
         3. translate any absolute paths to relative (with warning)
@@ -645,51 +2168,63 @@ class PatchSet(object):
         
         return None
     """
-    for i,p in enumerate(self.items):
-      if p.type in (HG, GIT):
-        # TODO: figure out how to deal with /dev/null entries
-        debug("stripping a/ and b/ prefixes")
-        if p.source != '/dev/null':
-          if not p.source.startswith("a/"):
-            warning("invalid source filename")
-          else:
-            p.source = p.source[2:]
-        if p.target != '/dev/null':
-          if not p.target.startswith("b/"):
-            warning("invalid target filename")
-          else:
-            p.target = p.target[2:]
+    if p.type in (HG, GIT):
+      debug("stripping a/ and b/ prefixes")
+      if p.source != DEVNULL:
+        if not p.source.startswith("a/"):
+          warning("invalid source filename")
+        else:
+          p.source = p.source[2:]
+      if p.target != DEVNULL:
+        if not p.target.startswith("b/"):
+          warning("invalid target filename")
+        else:
+          p.target = p.target[2:]
 
+    # DEVNULL marks created and deleted files and stays as it is
+    if p.source != DEVNULL:
       p.source = xnormpath(p.source)
+    if p.target != DEVNULL:
       p.target = xnormpath(p.target)
 
-      sep = '/'  # sep value can be hardcoded, but it looks nice this way
-
-      # references to parent are not allowed
-      if p.source.startswith(".." + sep):
-        warning("error: stripping parent path for source file patch no.%d" % (i+1))
-        self.warnings += 1
-        while p.source.startswith(".." + sep):
-          p.source = p.source.partition(sep)[2]
-      if p.target.startswith(".." + sep):
-        warning("error: stripping parent path for target file patch no.%d" % (i+1))
-        self.warnings += 1
-        while p.target.startswith(".." + sep):
-          p.target = p.target.partition(sep)[2]
-      # absolute paths are not allowed
-      if xisabs(p.source) or xisabs(p.target):
-        warning("error: absolute paths are not allowed - file no.%d" % (i+1))
-        self.warnings += 1
-        if xisabs(p.source):
-          warning("stripping absolute path from source name '%s'" % p.source)
-          p.source = xstrip(p.source)
-        if xisabs(p.target):
-          warning("stripping absolute path from target name '%s'" % p.target)
-          p.target = xstrip(p.target)
-    
-      self.items[i].source = p.source
-      self.items[i].target = p.target
-
+    sep = '/'  # sep value can be hardcoded, but it looks nice this way
+
+    # references to parent are not allowed
+    if p.source.startswith(".." + sep):
+      warning("error: stripping parent path for source file patch no.%d", no)
+      self.warnings += 1
+      while p.source.startswith(".." + sep):
+        p.source = p.source.partition(sep)[2]
+    if p.target.startswith(".." + sep):
+      warning("error: stripping parent path for target file patch no.%d", no)
+      self.warnings += 1
+      while p.target.startswith(".." + sep):
+        p.target = p.target.partition(sep)[2]
+    # absolute paths are not allowed
+    srcabs = p.source != DEVNULL and xisabs(p.source)
+    tgtabs = p.target != DEVNULL and xisabs(p.target)
+    if srcabs or tgtabs:
+      warning("error: absolute paths are not allowed - file no.%d", no)
+      self.warnings += 1
+      if srcabs:
+        warning("stripping absolute path from source name '%s'", p.source)
+        p.source = xstrip(p.source)
+      if tgtabs:
+        warning("stripping absolute path from target name '%s'", p.target)
+        p.target = xstrip(p.target)
+
+
+  def diffstat_dict(self):
+    """ calculate diffstat and return it as a dictionary with totals
+        and list of per file counters, suitable for JSON serialization
+    """
+    files = [dict(name=p.target if p.target != DEVNULL else p.source,
+                  insertions=p.insertions, deletions=p.deletions,
+                  delta=p.delta) for p in self.items]
+    return dict(files=files,
+                insertions=sum(f['insertions'] for f in files),
+                deletions=sum(f['deletions'] for f in files),
+                delta=sum(f['delta'] for f in files))
 
   def diffstat(self):
     """ calculate diffstat and return as a string
@@ -697,87 +2232,110 @@ class PatchSet(object):
           - original diffstat ouputs target filename
           - single + or - shouldn't escape histogram
     """
-    names = []
-    insert = []
-    delete = []
-    delta = 0    # size change in bytes
-    namelen = 0
-    maxdiff = 0  # max number of changes for single file
-                 # (for histogram width calculation)
-    for patch in self.items:
-      i,d = 0,0
-      for hunk in patch.hunks:
-        for line in hunk.text:
-          if line.startswith('+'):
-            i += 1
-            delta += len(line)-1
-          elif line.startswith('-'):
-            d += 1
-            delta -= len(line)-1
-      names.append(patch.target)
-      insert.append(i)
-      delete.append(d)
-      namelen = max(namelen, len(patch.target))
-      maxdiff = max(maxdiff, i+d)
-    output = ''
+    stat = self.diffstat_dict()
+    files = stat['files']
+    namelen = max([len(f['name']) for f in files] or [0])
+    # max number of changes for single file (for histogram width calculation)
+    maxdiff = max([f['insertions'] + f['deletions'] for f in files] or [0])
     statlen = len(str(maxdiff))  # stats column width
-    for i,n in enumerate(names):
-      # %-19s | %-4d %s
-      format = " %-" + str(namelen) + "s | %" + str(statlen) + "s %s\n"
-
-      hist = ''
+    # %-19s | %-4d %s
+    format = " %-" + str(namelen) + "s | %" + str(statlen) + "s %s\n"
+    width = len(format % ('', '', ''))
+    histwidth = max(2, 80 - width)
+
+    output = []
+    for f in files:
+      insert, delete = f['insertions'], f['deletions']
       # -- calculating histogram --
-      width = len(format % ('', '', ''))
-      histwidth = max(2, 80 - width)
       if maxdiff < histwidth:
-        hist = "+"*insert[i] + "-"*delete[i]
+        hist = "+"*insert + "-"*delete
       else:
-        iratio = (float(insert[i]) / maxdiff) * histwidth
-        dratio = (float(delete[i]) / maxdiff) * histwidth
+        iratio = (float(insert) / maxdiff) * histwidth
+        dratio = (float(delete) / maxdiff) * histwidth
 
         # make sure every entry gets at least one + or -
         iwidth = 1 if 0 < iratio < 1 else int(iratio)
         dwidth = 1 if 0 < dratio < 1 else int(dratio)
-        #print iratio, dratio, iwidth, dwidth, histwidth
         hist = "+"*int(iwidth) + "-"*int(dwidth)
       # -- /calculating +- histogram --
-      output += (format % (names[i], insert[i] + delete[i], hist))
- 
-    output += (" %d files changed, %d insertions(+), %d deletions(-), %+d bytes"
-               % (len(names), sum(insert), sum(delete), delta))
-    return output
+      output.append(format % (f['name'], insert + delete, hist))
+
+    output.append(" %d files changed, %d insertions(+), %d deletions(-), %+d bytes"
+                  % (len(files), stat['insertions'], stat['deletions'], stat['delta']))
+    return ''.join(output)
 
 
-  def findfile(self, old, new):
-    """ return name of file to be patched or None """
-    if exists(old):
+  def findfile(self, old, new, root=None):
+    """ return name of file to be patched or None, names are
+        looked up in `root` directory if it is given
+    """
+    return self._findname(old, new, lambda name: exists(rootpath(root, name)))
+
+  def _findname(self, old, new, isknown):
+    """ return name of file to be patched or None, `isknown`
+        is called to check if a file with given name exists
+    """
+    if isknown(old):
       return old
-    elif exists(new):
+    elif isknown(new):
       return new
     else:
       # [w] Google Code generates broken patches with its online editor
       debug("broken patch from Google Code, stripping prefixes..")
       if old.startswith('a/') and new.startswith('b/'):
         old, new = old[2:], new[2:]
-        debug("   %s" % old)
-        debug("   %s" % new)
-        if exists(old):
+        debug("   %s", old)
+        debug("   %s", new)
+        if isknown(old):
           return old
-        elif exists(new):
+        elif isknown(new):
           return new
       return None
 
 
-  def apply(self, strip=0, root=None):
+  def apply(self, strip=0, root=None, fuzz=None, jobs=None, atomic=False, cache=None):
     """ Apply parsed patch, optionally stripping leading components
         from file paths. `root` parameter specifies working dir.
+        `fuzz` enables GNU patch style placement of hunks at an offset,
+        ignoring up to `fuzz` lines of leading and trailing context.
+        `jobs` is the amount of threads to patch files with concurrently.
+        If `atomic` is True, patched files are staged next to originals
+        and only replace them if all files could be patched.
+        `cache` is a PatchCache to skip files with known outcome.
         return True on success
     """
-    if root:
-      prevdir = os.getcwd()
-      os.chdir(root)
+    return self._apply_patches(self.items, len(self.items), strip, root, fuzz,
+                               jobs, atomic, cache)
+
+  def apply_async(self, strip=0, root=None, fuzz=None, atomic=False, cache=None,
+                  chunksize=16, callback=None):
+    """ Apply parsed patch like `apply()`, but in a background thread,
+        returning PatchTask at once - its result is what `apply()` would
+        return. Cancelling the task stops patching before the next chunk
+        of `chunksize` files. Files patched so far are kept, unless
+        `atomic` is True - then staged files are rolled back.
+        `callback` is the same as for PatchTask.
+    """
+    def work(task):
+      return self._apply_patches(task.chunks(self.items, chunksize), len(self.items),
+                                 strip, root, fuzz, atomic=atomic, cache=cache)
+    return PatchTask(work, callback)
+
+  def apply_stream(self, stream, strip=0, root=None, fuzz=None):
+    """ Parse unified diff from stream and apply every file patch as
+        soon as it is parsed. Patches are not kept in `items`, so
+        memory is bounded by the hunks of a single file.
+        Arguments are the same as for `apply()`.
+        return True if parsing and patching succeeded
+    """
+    applied = self._apply_patches(self.iterparse(stream), '?', strip, root, fuzz)
+    return applied and self.errors == 0
 
-    total = len(self.items)
+  def _apply_patches(self, patches, total, strip, root, fuzz, jobs=None, atomic=False,
+                     cache=None):
+    """ apply all Patch objects from `patches` iterable, see `apply()`
+        `total` is the amount of patches used in messages
+    """
     errors = 0
     if strip:
       # [ ] test strip level exceeds nesting level
@@ -787,275 +2345,1026 @@ class PatchSet(object):
         strip = int(strip)
       except ValueError:
         errors += 1
-        warning("error: strip parameter '%s' must be an integer" % strip)
+        warning("error: strip parameter '%s' must be an integer", strip)
         strip = 0
 
-    #for fileno, filename in enumerate(self.source):
-    for i,p in enumerate(self.items):
-      if strip:
-        debug("stripping %s leading component(s) from:" % strip)
-        debug("   %s" % p.source)
-        debug("   %s" % p.target)
-        old = pathstrip(p.source, strip)
-        new = pathstrip(p.target, strip)
+    # filepath -> (patch index, staged file) for atomic mode
+    staged = None
+    if atomic:
+      staged = {}
+
+    try:
+      if jobs and jobs > 1:
+        errors += self._apply_parallel(patches, total, strip, root, fuzz, jobs, staged,
+                                       cache)
       else:
-        old, new = p.source, p.target
+        for i,p in enumerate(patches):
+          errors += self._apply_patch(p, i, total, strip, root, fuzz, staged, cache)
+    except:
+      if staged:
+        self._rollback(staged)
+      raise
+
+    if staged:
+      if errors:
+        warning("rolling back %d staged file(s)", len(staged))
+        self._rollback(staged)
+      else:
+        errors += self._commit(staged)
 
-      filename = self.findfile(old, new)
+    # todo: check for premature eof
+    return (errors == 0)
 
-      if not filename:
-          warning("source/target file does not exist:\n  --- %s\n  +++ %s" % (old, new))
-          errors += 1
+  def _stage(self, filepath):
+    """ return name of new empty temporary file in directory
+        of `filepath`, to be renamed over it on commit
+    """
+    self._makedirs(filepath)
+    dirname, basename = os.path.split(filepath)
+    fd, tmpname = tempfile.mkstemp(prefix="." + basename + ".", suffix=".tmp",
+                                   dir=dirname or os.curdir)
+    os.close(fd)
+    return tmpname
+
+  def _commit(self, staged):
+    """ move all staged files over their originals in order of
+        patches, return number of errors
+    """
+    errors = 0
+    # within a patch, renamed files are moved before their sources are removed
+    for i, removed, filepath, tmpname in sorted((i, t is None, f, t)
+                                                for f, (i, t) in staged.items()):
+      try:
+        if tmpname is None:
+          # file deleted or renamed by git patch
+          if exists(filepath):
+            os.unlink(filepath)
           continue
-      if not isfile(filename):
-        warning("not a file - %s" % filename)
+        if os.name == 'nt' and exists(filepath):
+          # rename doesn't replace files on windows
+          os.unlink(filepath)
+        os.rename(tmpname, filepath)
+      except OSError, e:
+        warning("error committing %s - %s", filepath, e)
         errors += 1
-        continue
+        if tmpname and not isinstance(tmpname, _Moved) and exists(tmpname):
+          os.unlink(tmpname)
+    staged.clear()
+    return errors
+
+  def _rollback(self, staged):
+    """ remove all staged files, leaving originals untouched """
+    for i, tmpname in staged.values():
+      if tmpname and not isinstance(tmpname, _Moved) and exists(tmpname):
+        os.unlink(tmpname)
+    staged.clear()
+
+  def _apply_parallel(self, patches, total, strip, root, fuzz, jobs, staged=None,
+                      cache=None):
+    """ apply patches using a pool of `jobs` threads and return number
+        of errors. Patches for the same file are applied in order by a
+        single worker, log records are emitted in order of patches.
+    """
+    # files touched by one patch (source and target of a rename) land
+    # in one group, groups that share a file are merged (union-find)
+    parent = {}
+    def find(name):
+      parent.setdefault(name, name)
+      while parent[name] != name:
+        parent[name] = parent[parent[name]]
+        name = parent[name]
+      return name
+
+    touched = []
+    for p in patches:
+      names = [name if not strip else pathstrip(name, strip)
+               for name in (p.source, p.target) if name != DEVNULL]
+      for name in names[1:]:
+        parent[find(name)] = find(names[0])
+      touched.append(names[0])
+
+    groups = []
+    byroot = {}
+    for i, p in enumerate(patches):
+      key = find(touched[i])
+      if key not in byroot:
+        byroot[key] = []
+        groups.append(byroot[key])
+      byroot[key].append((i, p))
+
+    def work(group):
+      results = []
+      try:
+        for i, p in group:
+          holding.local.records = records = []
+          results.append((i, self._apply_patch(p, i, total, strip, root, fuzz, staged,
+                                               cache),
+                          records))
+      finally:
+        holding.local.records = None
+      return results
 
-      # [ ] check absolute paths security here
-      debug("processing %d/%d:\t %s" % (i+1, total, filename))
-
-      # validate before patching
-      f2fp = open(filename)
-      hunkno = 0
-      hunk = p.hunks[hunkno]
-      hunkfind = []
-      hunkreplace = []
-      validhunks = 0
-      canpatch = False
-      for lineno, line in enumerate(f2fp):
-        if lineno+1 < hunk.startsrc:
-          continue
-        elif lineno+1 == hunk.startsrc:
-          hunkfind = [x[1:].rstrip("\r\n") for x in hunk.text if x[0] in " -"]
-          hunkreplace = [x[1:].rstrip("\r\n") for x in hunk.text if x[0] in " +"]
-          #pprint(hunkreplace)
-          hunklineno = 0
-
-          # todo \ No newline at end of file
-
-        # check hunks in source file
-        if lineno+1 < hunk.startsrc+len(hunkfind)-1:
-          if line.rstrip("\r\n") == hunkfind[hunklineno]:
-            hunklineno+=1
-          else:
-            info("file %d/%d:\t %s" % (i+1, total, filename))
-            info(" hunk no.%d doesn't match source file at line %d" % (hunkno+1, lineno))
-            info("  expected: %s" % hunkfind[hunklineno])
-            info("  actual  : %s" % line.rstrip("\r\n"))
-            # not counting this as error, because file may already be patched.
-            # check if file is already patched is done after the number of
-            # invalid hunks if found
-            # TODO: check hunks against source/target file in one pass
-            #   API - check(stream, srchunks, tgthunks)
-            #           return tuple (srcerrs, tgterrs)
-
-            # continue to check other hunks for completeness
-            hunkno += 1
-            if hunkno < len(p.hunks):
-              hunk = p.hunks[hunkno]
-              continue
-            else:
-              break
-
-        # check if processed line is the last line
-        if lineno+1 == hunk.startsrc+len(hunkfind)-1:
-          debug(" hunk no.%d for file %s  -- is ready to be patched" % (hunkno+1, filename))
-          hunkno+=1
-          validhunks+=1
-          if hunkno < len(p.hunks):
-            hunk = p.hunks[hunkno]
-          else:
-            if validhunks == len(p.hunks):
-              # patch file
-              canpatch = True
-              break
-      else:
-        if hunkno < len(p.hunks):
-          warning("premature end of source file %s at hunk %d" % (filename, hunkno+1))
-          errors += 1
+    errors = 0
+    done = {}
+    nextno = 0
+    pool = ThreadPool(jobs)
+    try:
+      for results in pool.imap_unordered(work, groups):
+        for i, errs, records in results:
+          done[i] = (errs, records)
+        while nextno in done:
+          errs, records = done.pop(nextno)
+          for record in records:
+            logger.handle(record)
+          errors += errs
+          nextno += 1
+    finally:
+      pool.close()
+      pool.join()
+    return errors
+
+  def _apply_patch(self, p, i, total, strip, root, fuzz, staged=None, cache=None):
+    """ apply single Patch with index `i` and return number of errors
+        patched file is staged instead of written if `staged` is a dict
+    """
+    errors = 0
+    if strip:
+      debug("stripping %s leading component(s) from:", strip)
+      debug("   %s", p.source)
+      debug("   %s", p.target)
+      old, new = [name if name == DEVNULL else pathstrip(name, strip)
+                  for name in (p.source, p.target)]
+    else:
+      old, new = p.source, p.target
 
-      f2fp.close()
+    if p.isgit():
+      return self._apply_git(p, i, total, old, new, root, fuzz, staged)
 
-      if validhunks < len(p.hunks):
-        if self._match_file_hunks(filename, p.hunks):
-          warning("already patched  %s" % filename)
+    if staged:
+      # files staged by previous patches of this set count as existing
+      filename = self._findname(old, new, lambda name: rootpath(root, name) in staged
+                                                       or exists(rootpath(root, name)))
+    else:
+      filename = self.findfile(old, new, root)
+
+    if not filename:
+      warning("source/target file does not exist:\n  --- %s\n  +++ %s", old, new)
+      return 1
+    filepath = rootpath(root, filename)
+
+    # patch file as changed by previous patches of this set
+    srcpath = self._staged_path(staged, filepath)
+    if srcpath is None:
+      warning("file is removed by previous patch - %s", filename)
+      return 1
+    if not isfile(srcpath):
+      warning("not a file - %s", filename)
+      return 1
+
+    # [ ] check absolute paths security here
+    debug("processing %d/%s:\t %s", i+1, total, filename)
+
+    key = None
+    if cache is not None and srcpath == filepath:
+      key = cache.patchkey(p, fuzz)
+      digest = cache.digest(filepath)
+      outcome = cache.get(key, digest)
+      if outcome is not None:
+        self.stats.cachehit()
+      if outcome == APPLIED:
+        warning("already patched  %s", filename)
+        return 0
+      elif outcome == CONFLICT:
+        warning("source file is different - %s", filename)
+        return 1
+
+    # validate before patching - the file is read only once and all
+    # hunks are checked against its line table
+    stats = self.stats
+    started = time.time()
+    moves = []
+    status, hunks = self._validate(p, self.linetable(srcpath), fuzz, filename, i, total,
+                                   moves)
+    stats.timed(filename, 'validate', time.time() - started)
+    if moves:
+      stats.fuzzed(filename, moves)
+    canpatch = (status == APPLIES)
+    if status == CONFLICT:
+      errors += 1
+    if key and not canpatch:
+      cache.set(key, digest, status)
+
+    started = time.time()
+    if canpatch and staged is not None:
+      tmpname = self._stage(filepath)
+      try:
+        self.write_hunks(srcpath, tmpname, hunks)
+      except:
+        os.unlink(tmpname)
+        raise
+      self._unstage(srcpath, filepath)
+      staged[filepath] = (i, tmpname)
+      info("staged %d/%s:\t %s", i+1, total, filename)
+      if key:
+        cache.set(key, filedigest(tmpname), APPLIED)
+    elif canpatch:
+      backupname = filepath+".orig"
+      if exists(backupname):
+        warning("can't backup original file to %s - aborting", backupname)
+      else:
+        shutil.move(filepath, backupname)
+        if self.write_hunks(backupname, filepath, hunks):
+          info("successfully patched %d/%s:\t %s", i+1, total, filename)
+          os.unlink(backupname)
+          if key:
+            cache.set(key, cache.digest(filepath), APPLIED)
         else:
-          warning("source file is different - %s" % filename)
           errors += 1
-      if canpatch:
-        backupname = filename+".orig"
-        if exists(backupname):
-          warning("can't backup original file to %s - aborting" % backupname)
-        else:
-          import shutil
-          shutil.move(filename, backupname)
-          if self.write_hunks(backupname, filename, p.hunks):
-            info("successfully patched %d/%d:\t %s" % (i+1, total, filename))
-            os.unlink(backupname)
-          else:
-            errors += 1
-            warning("error patching file %s" % filename)
-            shutil.copy(filename, filename+".invalid")
-            warning("invalid version is saved to %s" % filename+".invalid")
-            # todo: proper rejects
-            shutil.move(backupname, filename)
+          warning("error patching file %s", filename)
+          shutil.copy(filepath, filepath+".invalid")
+          warning("invalid version is saved to %s", filename+".invalid")
+          # todo: proper rejects
+          shutil.move(backupname, filepath)
+    if canpatch:
+      stats.timed(filename, 'write', time.time() - started)
+
+    return errors
+
+  def _apply_git(self, p, i, total, old, new, root, fuzz, staged=None):
+    """ create, delete or rename file `old` of Patch with index `i` and
+        change its mode as told by git extended header, applying hunks on
+        the way. Renamed files are moved, not rewritten, unless they have
+        hunks. Changes are staged instead if `staged` is a dict.
+        return number of errors
+    """
+    srcpath = rootpath(root, old) if old != DEVNULL else None
+    tgtpath = rootpath(root, new) if new != DEVNULL else None
+    filename = new if new != DEVNULL else old
+    debug("processing %d/%s:\t %s", i+1, total, filename)
+
+    # files as changed by previous patches of this set
+    readpath = curtgtpath = None
+    if srcpath:
+      readpath = self._staged_path(staged, srcpath)
+      if readpath is None:
+        warning("file is removed by previous patch - %s", old)
+        return 1
+    if tgtpath:
+      curtgtpath = self._staged_path(staged, tgtpath)
+    tgtexists = curtgtpath is not None and exists(curtgtpath)
+
+    lines = None
+    if srcpath is None:
+      if tgtexists:
+        return self._git_applied(p, curtgtpath, filename)
+      lines = []
+    elif not exists(readpath):
+      if tgtpath is None:
+        warning("already patched  %s", filename)
+        return 0
+      if p.rename and tgtexists:
+        return self._git_applied(p, curtgtpath, filename)
+      warning("source file does not exist - %s", old)
+      return 1
+    elif not isfile(readpath):
+      warning("not a file - %s", old)
+      return 1
+    elif p.rename and tgtexists:
+      warning("target of rename exists - %s", new)
+      return 1
+    elif p.hunks or tgtpath is None:
+      # plain renames and mode changes don't need file contents
+      lines = self.linetable(readpath)
+
+    hunks = []
+    if tgtpath is None:
+      # all lines of deleted file must be removed by hunks
+      if lines != [line for h in p.hunks for line in h.srclines]:
+        warning("file to be deleted is different - %s", filename)
+        return 1
+    elif lines is not None:
+      status, hunks = self._validate(p, lines, fuzz, filename, i, total)
+      if status == CONFLICT:
+        return 1
+      if status == APPLIED:
+        hunks = []
+
+    if staged is not None:
+      if tgtpath and p.rename and not hunks and p.newmode is None:
+        # renamed file is moved on commit, not copied
+        self._makedirs(tgtpath)
+        tmpname = readpath
+        if readpath == srcpath:
+          tmpname = _Moved(srcpath)
+        staged[tgtpath] = (i, tmpname)
+      elif tgtpath:
+        tmpname = self._stage(tgtpath)
+        try:
+          self._git_write(p, readpath, tmpname, hunks)
+        except:
+          os.unlink(tmpname)
+          raise
+        if readpath:
+          self._unstage(readpath, srcpath)
+        staged[tgtpath] = (i, tmpname)
+      elif readpath:
+        self._unstage(readpath, srcpath)
+      if srcpath and srcpath != tgtpath:
+        staged[srcpath] = (i, None)  # removed on commit
+      info("staged %d/%s:\t %s", i+1, total, filename)
+      return 0
+
+    if tgtpath is None:
+      os.unlink(srcpath)
+      info("deleted %d/%s:\t %s", i+1, total, filename)
+      return 0
+    if p.rename:
+      self._makedirs(tgtpath)
+      os.rename(srcpath, tgtpath)
+      srcpath = tgtpath
+    if srcpath is None or hunks:
+      tmpname = self._stage(tgtpath)
+      try:
+        self._git_write(p, srcpath, tmpname, hunks)
+        if os.name == 'nt' and exists(tgtpath):
+          os.unlink(tgtpath)
+        os.rename(tmpname, tgtpath)
+      except:
+        if exists(tmpname):
+          os.unlink(tmpname)
+        raise
+    elif p.newmode is not None:
+      os.chmod(tgtpath, p.newmode & 07777)
+    info("successfully patched %d/%s:\t %s", i+1, total, filename)
+    return 0
+
+  def _staged_path(self, staged, filepath):
+    """ return path of file with current contents of `filepath` - its
+        staged file if previous patches of the set changed it, or None
+        if they removed it
+    """
+    if staged is not None and filepath in staged:
+      return staged[filepath][1]
+    return filepath
 
-    if root:
-      os.chdir(prevdir)
+  def _unstage(self, readpath, filepath):
+    """ remove staged file `readpath` of `filepath` that was replaced
+        by a newer one, originals are left alone
+    """
+    if readpath != filepath and not isinstance(readpath, _Moved):
+      os.unlink(readpath)
 
-    # todo: check for premature eof
-    return (errors == 0)
+  def _git_write(self, p, srcpath, tmpname, hunks):
+    """ write file `srcpath` (None for a new file) patched with hunks
+        into `tmpname`, giving it file mode of Patch if it has one
+    """
+    if srcpath is None:
+      fp = open(tmpname, "wb")
+      try:
+        fp.write(''.join(self.patch_stream(StringIO(''), hunks)))
+      finally:
+        fp.close()
+      # temporary files are private, new ones get the default mode
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(tmpname, 0666 & ~umask)
+    elif hunks:
+      self.write_hunks(srcpath, tmpname, hunks)
+    else:
+      shutil.copyfile(srcpath, tmpname)
+      shutil.copymode(srcpath, tmpname)
+    if p.newmode is not None:
+      os.chmod(tmpname, p.newmode & 07777)
+
+  def _git_applied(self, p, tgtpath, filename):
+    """ check file at target path of created or renamed file, return 0
+        if Patch is applied to it already and 1 otherwise
+    """
+    if isfile(tgtpath) and self._match_target(self.linetable(tgtpath), p.hunks):
+      warning("already patched  %s", filename)
+      return 0
+    warning("file already exists - %s", filename)
+    return 1
+
+  def _makedirs(self, filepath):
+    """ create missing parent directories of `filepath` """
+    dirname = os.path.dirname(filepath)
+    if dirname and not exists(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError, e:
+        # other worker may have created it in the meantime
+        if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+          raise
+
+  def _validate(self, p, lines, fuzz, filename, i, total, moves=None):
+    """ check Patch against line table of `filename` and log the outcome
+        return tuple (status, hunks) where status is APPLIES, APPLIED or
+        CONFLICT, and hunks are the (possibly relocated) hunks to write
+        `moves` is passed to `_place()`
+    """
+    outcome, status, hunks = self._outcome(p, lines, fuzz, moves)
+    if outcome == APPLIES:
+      return APPLIES, hunks
+    if outcome == APPLIED:
+      warning("already patched  %s", filename)
+      return APPLIED, hunks
+
+    info("file %d/%s:\t %s", i+1, total, filename)
+    for hno, h in enumerate(p.hunks):
+      if status[hno] != CONFLICT:
+        continue
+      find = list(h.srclines)
+      start = max(h.startsrc-1, 0)
+      if start+len(find) > len(lines):
+        warning("premature end of source file %s at hunk %d", filename, hno+1)
+        continue
+      for offset, hline in enumerate(find):
+        if lines[start+offset] != hline:
+          info(" hunk no.%d doesn't match source file at line %d", hno+1, start+offset+1)
+          info("  expected: %s", hline)
+          info("  actual  : %s", lines[start+offset])
+          break
+    warning("source file is different - %s", filename)
+    return CONFLICT, hunks
 
+  def _outcome(self, p, lines, fuzz, moves=None):
+    """ return tuple (outcome, status, hunks) for Patch checked against
+        line table, where outcome is APPLIES, APPLIED or CONFLICT for the
+        whole file and status lists the status of every hunk
+    """
+    placed = self._place(lines, p.hunks, fuzz, moves)
+    status = [s for s, h in placed]
+    hunks = [h for s, h in placed]
+    if status.count(APPLIES) == len(p.hunks):
+      return APPLIES, status, hunks
+    if status.count(APPLIED) == len(p.hunks) or self._match_target(lines, p.hunks):
+      return APPLIED, status, hunks
+    return CONFLICT, status, hunks
+
+  def apply_buffers(self, files, strip=0, fuzz=None):
+    """ Apply parsed patch to files in memory, without any disk I/O.
+        `files` maps file names to their contents, given as string or
+        file-like object. `strip` and `fuzz` are the same as for `apply()`.
+
+        return dict mapping names of patched files to new contents - None
+        for files deleted or renamed away by git patches, or False if a
+        file is missing or can't be patched
+    """
+    contents = {}
+    loaded = {}  # file-like objects are read only once
+    def current(name):
+      if name in contents:
+        return contents[name]
+      data = files.get(name)
+      if hasattr(data, 'read'):
+        if name not in loaded:
+          loaded[name] = data.read()
+        data = loaded[name]
+      return data
+    def isknown(name):
+      return current(name) is not None
 
-  def _reverse(self):
-    """ reverse patch direction (this doesn't touch filenames) """
-    for p in self.items:
-      for h in p.hunks:
-        h.startsrc, h.starttgt = h.starttgt, h.startsrc
-        h.linessrc, h.linestgt = h.linestgt, h.linessrc
-        for i,line in enumerate(h.text):
-          if line[0] == '+':
-            h.text[i] = '-' + line[1:]
-          elif line[0] == '-':
-            h.text[i] = '+' +line[1:]
-
-  def revert(self, strip=0, root=None):
+    errors = 0
+    total = len(self.items)
+    for i, p in enumerate(self.items):
+      if strip:
+        old, new = [name if name == DEVNULL else pathstrip(name, int(strip))
+                    for name in (p.source, p.target)]
+      else:
+        old, new = p.source, p.target
+      if p.rename or DEVNULL in (old, new):
+        errors += self._apply_git_buffer(p, i, total, old, new, fuzz, current, contents)
+        continue
+      filename = self._findname(old, new, isknown)
+      if not filename:
+        warning("source/target file does not exist:\n  --- %s\n  +++ %s", old, new)
+        errors += 1
+        continue
+      data = current(filename)
+
+      started = time.time()
+      moves = []
+      status, hunks = self._validate(p, self._lines(StringIO(data)), fuzz, filename, i, total,
+                                     moves)
+      self.stats.timed(filename, 'validate', time.time() - started)
+      if moves:
+        self.stats.fuzzed(filename, moves)
+      if status == CONFLICT:
+        errors += 1
+      elif status == APPLIES:
+        started = time.time()
+        data = ''.join(self.patch_stream(StringIO(data), hunks))
+        self.stats.timed(filename, 'write', time.time() - started)
+        info("successfully patched %d/%s:\t %s", i+1, total, filename)
+      contents[filename] = data
+
+    if errors:
+      return False
+    return contents
+
+  def _apply_git_buffer(self, p, i, total, old, new, fuzz, current, contents):
+    """ create, delete or rename file of Patch in memory, like
+        `_apply_git()` does on disk. `current` returns contents of
+        a file, or None if it doesn't exist. File modes are ignored.
+        return number of errors
+    """
+    filename = new if new != DEVNULL else old
+    if old == DEVNULL:
+      data = ''
+      existing = current(new)
+      if existing is not None:
+        if self._match_target(self._lines(StringIO(existing)), p.hunks):
+          warning("already patched  %s", filename)
+          contents[new] = existing
+          return 0
+        warning("file already exists - %s", filename)
+        return 1
+    else:
+      data = current(old)
+      if data is None:
+        target = current(new) if new != DEVNULL else None
+        if new == DEVNULL or (target is not None and
+                              self._match_target(self._lines(StringIO(target)), p.hunks)):
+          warning("already patched  %s", filename)
+          contents[old] = None
+          if target is not None:
+            contents[new] = target
+          return 0
+        warning("source file does not exist - %s", old)
+        return 1
+      if new != DEVNULL and current(new) is not None:
+        warning("target of rename exists - %s", new)
+        return 1
+
+    lines = self._lines(StringIO(data))
+    if new == DEVNULL:
+      # all lines of deleted file must be removed by hunks
+      if lines != [line for h in p.hunks for line in h.srclines]:
+        warning("file to be deleted is different - %s", filename)
+        return 1
+      contents[old] = None
+      info("deleted %d/%s:\t %s", i+1, total, filename)
+      return 0
+
+    status, hunks = self._validate(p, lines, fuzz, filename, i, total)
+    if status == CONFLICT:
+      return 1
+    if status == APPLIES:
+      data = ''.join(self.patch_stream(StringIO(data), hunks))
+    if old != DEVNULL:
+      contents[old] = None
+    contents[new] = data
+    info("successfully patched %d/%s:\t %s", i+1, total, filename)
+    return 0
+
+
+  def reversed(self):
+    """ return view of the patch set with reversed direction of patches
+        (this doesn't touch filenames). Nothing is copied but the list
+        of patches - source and target of hunks are swapped on access.
+    """
+    view = copy.copy(self)
+    view.items = [p.reversed() for p in self.items]
+    view._mapped = []  # maps are closed by the original
+    return view
+
+  def revert(self, strip=0, root=None, fuzz=None, jobs=None, atomic=False, cache=None):
     """ apply patch in reverse order """
-    reverted = copy.deepcopy(self)
-    reverted._reverse()
-    return reverted.apply(strip, root)
+    return self.reversed().apply(strip, root, fuzz, jobs, atomic, cache)
+
+  def prepared(self):
+    """ return copy of the patch set with PreparedHunk copies of all
+        hunks, which are faster to match against many files
+    """
+    view = copy.copy(self)
+    view.items = []
+    for p in self.items:
+      q = Patch()
+      q.source, q.target, q.header, q.type = p.source, p.target, p.header, p.type
+      q.hunkends = p.hunkends
+      q.insertions, q.deletions, q.delta = p.insertions, p.deletions, p.delta
+      q.rename, q.oldmode, q.newmode, q.similarity = (p.rename, p.oldmode, p.newmode,
+                                                      p.similarity)
+      q.hunks = [PreparedHunk(h) for h in p.hunks]
+      view.items.append(q)
+    view._sourceindex = None
+    view._mapped = []
+    return view
+
+  def apply_many(self, roots, strip=0, fuzz=None, jobs=None, atomic=False):
+    """ Apply parsed patch to every directory in `roots`. Hunks are
+        prepared for matching only once (see `prepared()`), and `jobs`
+        threads patch different roots concurrently. Log records are
+        emitted in order of roots. Other arguments are the same as for
+        `apply()`.
+
+        return dict mapping every root to its report - dict with
+        `success` flag, `stats` PatchStats of the root and `error`
+        message if patching was aborted by an I/O error
+    """
+    prepared = self.prepared()
+    total = len(prepared.items)
+
+    def work(root):
+      view = copy.copy(prepared)
+      view.stats = PatchStats()
+      view._sourceindex = None
+      report = dict(success=False, stats=view.stats, error=None)
+      try:
+        report['success'] = view._apply_patches(view.items, total, strip, root, fuzz,
+                                                atomic=atomic)
+      except EnvironmentError, e:
+        warning("error patching %s - %s", root, e)
+        report['error'] = str(e)
+      return report
+
+    def held(root):
+      holding.local.records = records = []
+      try:
+        return root, work(root), records
+      finally:
+        holding.local.records = None
+
+    reports = {}
+    if not jobs or jobs < 2:
+      for root in roots:
+        reports[root] = work(root)
+      return reports
 
+    pool = ThreadPool(jobs)
+    try:
+      for root, report, records in pool.imap(held, roots):
+        for record in records:
+          logger.handle(record)
+        reports[root] = report
+    finally:
+      pool.close()
+      pool.join()
+    return reports
 
-  def can_patch(self, filename):
+
+  def can_patch(self, filename, root=None):
     """ Check if specified filename can be patched. Returns None if file can
     not be found among source filenames. False if patch can not be applied
-    clearly. True otherwise.
+    clearly. True otherwise. Relative names are looked up in `root` if given.
 
     :returns: True, False or None
     """
-    filename = abspath(filename)
+    filename = abspath(rootpath(root, filename))
+    p = self.sourceindex(root).get(filename)
+    if p is None:
+      return None
+    return self._match_file_hunks(filename, p.hunks)
+
+  def sourceindex(self, root=None):
+    """ return dict mapping absolute source paths, resolved against
+        `root` if given, to their Patch objects. The index is built once
+        and reused as long as items of the patch set are not replaced
+        and paths resolve against the same directory.
+    """
+    # relative paths resolve against current dir, which may change
+    base = abspath(root) if root else os.getcwd()
+    cached = self._sourceindex
+    if (cached and cached[0] is self.items and cached[1] == len(self.items)
+        and cached[2] == base):
+      return cached[3]
+    index = {}
     for p in self.items:
-      if filename == abspath(p.source):
-        return self._match_file_hunks(filename, p.hunks)
-    return None
+      if p.source == DEVNULL:
+        continue  # created files have no source
+      # the first patch for a file wins, like in a linear scan
+      index.setdefault(abspath(rootpath(root, p.source)), p)
+    self._sourceindex = (self.items, len(self.items), base, index)
+    return index
+
+  def can_patch_all(self, filenames=None, root=None, fuzz=None):
+    """ Check many files in one pass. `filenames` default to source
+        filenames of all patches, relative names are looked up in `root`
+        if given. `fuzz` is the same as for `apply()`.
+
+        return dict mapping every filename to APPLIES, APPLIED or CONFLICT,
+        or to None if file is not among source filenames or doesn't exist
+    """
+    index = self.sourceindex(root)
+    if filenames is None:
+      filenames = [p.source for p in self.items if p.source != DEVNULL]
+    result = {}
+    for filename in filenames:
+      filepath = abspath(rootpath(root, filename))
+      p = index.get(filepath)
+      if p is None or not isfile(filepath):
+        result[filename] = None
+        continue
+      lines = self.linetable(filepath)
+      if p.target == DEVNULL:
+        # file to be deleted must have exactly the removed lines
+        if lines == [line for h in p.hunks for line in h.srclines]:
+          result[filename] = APPLIES
+        else:
+          result[filename] = CONFLICT
+        continue
+      result[filename] = self._outcome(p, lines, fuzz)[0]
+    return result
 
 
   def _match_file_hunks(self, filepath, hunks):
-    matched = True
-    fp = open(abspath(filepath))
+    return self._match_target(self.linetable(abspath(filepath)), hunks)
 
-    class NoMatch(Exception):
-      pass
 
-    lineno = 1
-    line = fp.readline()
-    hno = None
+  def linetable(self, filename):
+    """ read file once and return list of its lines with
+        line ends stripped, index 0 being the first line
+    """
+    fp = open(filename, "rb")
     try:
-      for hno, h in enumerate(hunks):
-        # skip to first line of the hunk
-        while lineno < h.starttgt:
-          if not len(line): # eof
-            debug("check failed - premature eof before hunk: %d" % (hno+1))
-            raise NoMatch
-          line = fp.readline()
-          lineno += 1
-        for hline in h.text:
-          if hline.startswith("-"):
-            continue
-          if not len(line):
-            debug("check failed - premature eof on hunk: %d" % (hno+1))
-            # todo: \ No newline at the end of file
-            raise NoMatch
-          if line.rstrip("\r\n") != hline[1:].rstrip("\r\n"):
-            debug("file is not patched - failed hunk: %d" % (hno+1))
-            raise NoMatch
-          line = fp.readline()
-          lineno += 1
-
-    except NoMatch:
-      matched = False
-      # todo: display failed hunk, i.e. expected/found
+      return self._lines(fp)
+    finally:
+      fp.close()
 
-    fp.close()
-    return matched
+  def _lines(self, stream):
+    """ return line table of all lines in stream """
+    return [splitend(line)[0] for line in stream]
+
+  def _match_lines(self, lines, start, hunklines):
+    """ check if `hunklines` view is found in line table at
+        line number `start` (line count starts with 1)
+    """
+    count = len(hunklines)
+    # hunks with empty side like @@ -0,0 +1 @@ are positioned
+    # after the given line
+    if not count:
+      return start <= len(lines)
+    start -= 1
+    if start < 0 or start + count > len(lines):
+      return False
+    if isinstance(hunklines, list):
+      return lines[start:start+count] == hunklines
+    for lineno, line in enumerate(hunklines, start):
+      if lines[lineno] != line:
+        return False
+    return True
+
+  def _match_target(self, lines, hunks):
+    """ return True if all hunks are already applied to line table """
+    for hno, h in enumerate(hunks):
+      if not self._match_lines(lines, h.starttgt, h.tgtlines):
+        debug("file is not patched - failed hunk: %d", hno+1)
+        return False
+    return True
+
+  def check(self, lines, hunks, fuzz=None):
+    """ Check hunks against source and target context of a file in a
+        single pass over hunks. `lines` is the line table of the file
+        as returned by `linetable()`. If `fuzz` is not None, hunks
+        are also looked up at an offset (see `apply()`).
+        
+        Returns list with status for every hunk - APPLIES if hunk can
+        be applied, APPLIED if it is already applied and CONFLICT if
+        neither is the case.
+    """
+    return [s for s, h in self._place(lines, hunks, fuzz)]
+
+  def _place(self, lines, hunks, fuzz=None, moves=None):
+    """ Return list of (status, hunk) tuples for hunks checked against
+        line table. Hunks found at an offset or with fuzz are replaced
+        by relocated copies that can be passed to `write_hunks()`.
+        If `moves` list is given, (hunk no., offset, fuzz) tuples of
+        relocated hunks are appended to it.
+    """
+    result = []
+    index = None   # line hash index, created on first fuzzy lookup
+    offset = 0     # offset of the last hunk placed with fuzz
+    minline = 0    # hunks are not placed before the end of previous one
+    for hno, h in enumerate(hunks):
+      pos, end = _span(h.startsrc, h.linessrc)
+      # hunk that matches before the end of previous (relocated) one
+      # is looked up after it, the file is written in order of hunks
+      if pos >= minline and self._match_lines(lines, h.startsrc, h.srclines):
+        debug(" hunk no.%d -- is ready to be patched", hno+1)
+        result.append((APPLIES, h))
+        minline = end
+        continue
+      if self._match_lines(lines, h.starttgt, h.tgtlines):
+        result.append((APPLIED, h))
+        continue
+      if fuzz is None:
+        result.append((CONFLICT, h))
+        continue
+
+      if index is None:
+        index = self._lineindex(lines)
+      located = self._locate(lines, index, h, " -", h.startsrc - 1 + offset, minline, fuzz)
+      if located:
+        pos, headcut, tailcut = located
+        fuzzlevel = max(headcut, tailcut)
+        relocated = self._relocate(h, pos+1, headcut, tailcut)
+        offset = relocated.startsrc - h.startsrc - headcut
+        info(" hunk no.%d applies at line %d (offset %d lines, fuzz %d)",
+             hno+1, pos+1, offset, fuzzlevel)
+        if moves is not None:
+          moves.append((hno+1, offset, fuzzlevel))
+        minline = pos + relocated.linessrc
+        result.append((APPLIES, relocated))
+      elif self._locate(lines, index, h, " +", h.starttgt - 1 + offset, 0, fuzz):
+        result.append((APPLIED, h))
+      else:
+        result.append((CONFLICT, h))
+    return result
+
+  def _lineindex(self, lines):
+    """ return hash index of line table, mapping every line to the
+        ascending list of its positions (counting from 0)
+    """
+    index = {}
+    for lineno, line in enumerate(lines):
+      if line in index:
+        index[line].append(lineno)
+      else:
+        index[line] = [lineno]
+    return index
+
+  def _locate(self, lines, index, hunk, side, expected, minline, fuzz):
+    """ find hunk lines of given `side` (" -" for source, " +" for target)
+        in line table using its hash `index`. Context lines are ignored
+        at the edges of the hunk up to `fuzz` lines, the position closest
+        to `expected` (counting from 0) wins.
+
+        return tuple (position, headcut, tailcut) or None if not found
+    """
+    hunklines = list(HunkLines(hunk, side))
+    # count context lines at both edges - only those may be ignored
+    ops = hunk.ops
+    headctx = 0
+    while headctx < len(ops) and ops[headctx] == " ":
+      headctx += 1
+    tailctx = 0
+    while tailctx < len(ops) - headctx and ops[-1-tailctx] == " ":
+      tailctx += 1
+
+    for level in range(fuzz+1):
+      headcut = min(level, headctx)
+      tailcut = min(level, tailctx)
+      if level and not (headcut == level or tailcut == level):
+        break  # nothing left to be ignored
+      find = hunklines[headcut:len(hunklines)-tailcut]
+      if not find:
+        break
+      # the rarest line of the hunk is the anchor for lookup in index
+      anchor = min(range(len(find)), key=lambda k: len(index.get(find[k], ())))
+      candidates = [pos - anchor for pos in index.get(find[anchor], ())
+                    if pos - anchor >= minline]
+      candidates.sort(key=lambda pos: abs(pos - expected - headcut))
+      for pos in candidates:
+        if lines[pos:pos+len(find)] == find:
+          return pos, headcut, tailcut
+    return None
+
+  def _relocate(self, hunk, start, headcut, tailcut):
+    """ return copy of the hunk starting at source line `start` with
+        `headcut` leading and `tailcut` trailing context lines removed
+    """
+    h = Hunk()
+    end = len(hunk.ops) - tailcut
+    h.ops = hunk.ops[headcut:end]
+    h.lines = hunk.lines[headcut:end]
+    h.ends = hunk.ends[headcut:end]
+    h.startsrc = start
+    h.linessrc = hunk.linessrc - headcut - tailcut
+    h.starttgt = hunk.starttgt + (start - hunk.startsrc)
+    h.linestgt = hunk.linestgt - headcut - tailcut
+    h.invalid = hunk.invalid
+    h.desc = hunk.desc
+    return h
 
 
   def patch_stream(self, instream, hunks):
     """ Generator that yields stream patched with hunks iterable
     
         Converts lineends in hunk lines to the best suitable format
-        autodetected from input
+        autodetected from input - if all lines of input end the same
+        way, hunk lines get this line end, otherwise (mixed or none)
+        they keep their own
     """
 
-    # todo: At the moment substituted lineends may not be the same
-    #       at the start and at the end of patching. Also issue a
-    #       warning/throw about mixed lineends (is it really needed?)
+    # todo: issue a warning/throw about mixed lineends (is it really needed?)
+
+    # input is profiled once up front, streams that can't seek are read
+    try:
+      start = instream.tell()
+      newline = lineend(instream)
+      instream.seek(start)
+    except (AttributeError, IOError):
+      instream = StringIO(instream.read())
+      newline = lineend(instream)
+      instream.seek(0)
 
     hunks = iter(hunks)
 
     srclineno = 1
 
-    lineends = {'\n':0, '\r\n':0, '\r':0}
-    def get_line():
-      """
-      local utility function - return line from source stream
-      collecting line end statistics on the way
-      """
-      line = instream.readline()
-        # 'U' mode works only with text files
-      if line.endswith("\r\n"):
-        lineends["\r\n"] += 1
-      elif line.endswith("\n"):
-        lineends["\n"] += 1
-      elif line.endswith("\r"):
-        lineends["\r"] += 1
-      return line
-
     for hno, h in enumerate(hunks):
-      debug("hunk %d" % (hno+1))
-      # skip to line just before hunk starts
-      while srclineno < h.startsrc:
-        yield get_line()
+      debug("hunk %d", hno+1)
+      # skip to line just before hunk starts, hunks with empty source
+      # like @@ -3,0 +4 @@ are inserted after the given line
+      while srclineno < h.startsrc + (not h.linessrc):
+        yield instream.readline()
         srclineno += 1
 
-      for hline in h.text:
-        # todo: check \ No newline at the end of file
-        if hline.startswith("-") or hline.startswith("\\"):
-          get_line()
+      ops = h.ops
+      for k, (op, line, end) in enumerate(izip(ops, h.lines, h.ends)):
+        if op == "\\":
+          continue  # marker of the line before, not a line of source
+        if op != "+":
+          instream.readline()
           srclineno += 1
+        if op == "-":
           continue
+        if k + 1 < len(ops) and ops[k+1] == "\\":
+          yield line  # \ No newline at end of file
         else:
-          if not hline.startswith("+"):
-            get_line()
-            srclineno += 1
-          line2write = hline[1:]
-          # detect if line ends are consistent in source file
-          if sum([bool(lineends[x]) for x in lineends]) == 1:
-            newline = [x for x in lineends if lineends[x] != 0][0]
-            yield line2write.rstrip("\r\n")+newline
-          else: # newlines are mixed
-            yield line2write
+          yield line + (newline or LINEENDS[end])
      
     for line in instream:
       yield line
 
 
-  def write_hunks(self, srcname, tgtname, hunks):
+  def write_hunks(self, srcname, tgtname, hunks, root=None):
+    """ write `srcname` patched with hunks into `tgtname`, both
+        are looked up in `root` directory if it is given
+
+        Produces the same output as `patch_stream()`, but only lines
+        touched by hunks pass through Python - unchanged ranges between
+        them are copied with `copyrange()`.
+    """
+    srcname = rootpath(root, srcname)
+    tgtname = rootpath(root, tgtname)
     src = open(srcname, "rb")
     tgt = open(tgtname, "wb")
 
-    debug("processing target file %s" % tgtname)
+    debug("processing target file %s", tgtname)
 
-    tgt.writelines(self.patch_stream(src, hunks))
+    try:
+      srcfd = src.fileno()
+      tgtfd = tgt.fileno()
+      newline = lineend(src)
+      srclineno = 1
+      pos = 0
+      for h in hunks:
+        # copy lines before hunk starts
+        startsrc = h.startsrc + (not h.linessrc)
+        if srclineno < startsrc:
+          end = self._skiplines(src, pos, startsrc - srclineno)
+          copyrange(srcfd, tgtfd, pos, end - pos)
+          pos = end
+          srclineno = startsrc
+
+        src.seek(pos)
+        output = []
+        ops = h.ops
+        for k, (op, line, end) in enumerate(izip(ops, h.lines, h.ends)):
+          if op == "\\":
+            continue  # marker of the line before, see patch_stream()
+          if op != "+":
+            pos += len(src.readline())
+            srclineno += 1
+            if op == "-":
+              continue
+          if k + 1 < len(ops) and ops[k+1] == "\\":
+            output.append(line)
+          else:
+            output.append(line + (newline or LINEENDS[end]))
+        writeall(tgtfd, ''.join(output))
 
-    tgt.close()
-    src.close()
+      copyrange(srcfd, tgtfd, pos, os.fstat(srcfd).st_size - pos)
+    finally:
+      tgt.close()
+      src.close()
     # [ ] TODO: add test for permission copy
     shutil.copymode(srcname, tgtname)
     return True
 
 
+  def _skiplines(self, src, pos, count):
+    """ return offset of the line `count` lines after offset `pos` of
+        file object `src`. Lines are located by bulk scans of blocks
+    """
+    src.seek(pos)
+    while count > 0:
+      block = src.read(65536)
+      if not block:
+        break
+      newlines = block.count('\n')
+      if newlines >= count:
+        end = -1
+        for n in xrange(count):
+          end = block.find('\n', end+1)
+        return pos + end + 1
+      pos += len(block)
+      count -= newlines
+    return pos
+
+
   def dump(self):
     for p in self.items:
       for headline in p.header:
@@ -1088,6 +3397,12 @@ if __name__ == "__main__":
                                            help="specify root directory for applying patch")
   opt.add_option("-p", "--strip", type="int", metavar='N', default=0,
                                            help="strip N path components from filenames")
+  opt.add_option("-F", "--fuzz", type="int", metavar='N', default=None,
+                                           help="place hunks at an offset, ignoring up to N lines of context")
+  opt.add_option("-j", "--jobs", type="int", metavar='N', default=None,
+                                           help="parse and patch using N concurrent workers")
+  opt.add_option("--cache", metavar='FILE',
+                                           help="remember outcome per file in FILE to skip unchanged files")
   opt.add_option("--revert", action="store_true",
                                            help="apply patch in reverse order (unpatch)")
   (options, args) = opt.parse_args()
@@ -1123,17 +3438,26 @@ if __name__ == "__main__":
     else:
       if not exists(patchfile) or not isfile(patchfile):
         sys.exit("patch file does not exist - %s" % patchfile)
-      patch = fromfile(patchfile)
+      patch = fromfile(patchfile, options.jobs)
 
   if options.diffstat:
     print patch.diffstat()
     sys.exit(0)
 
+  cache = None
+  if options.cache:
+    cache = PatchCache(options.cache)
+
   #pprint(patch)
   if options.revert:
-    patch.revert(options.strip, root=options.directory) or sys.exit(-1)
+    success = patch.revert(options.strip, root=options.directory, fuzz=options.fuzz,
+                           jobs=options.jobs, cache=cache)
   else:
-    patch.apply(options.strip, root=options.directory) or sys.exit(-1)
+    success = patch.apply(options.strip, root=options.directory, fuzz=options.fuzz,
+                          jobs=options.jobs, cache=cache)
+  if cache:
+    cache.save()
+  success or sys.exit(-1)
 
   # todo: document and test line ends handling logic - patch.py detects proper line-endings
   #       for inserted hunks and issues a warning if patched file has incosistent line ends